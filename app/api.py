@@ -1,13 +1,42 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from typing import Any, Dict, List, Union
+
+import numpy as np
+from fastapi import Body, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-from datetime import datetime
-import pytz
-import joblib
-import os
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from app.batch import build_batch, parse_trip, single_trip, to_columns
+from app.batching import MicroBatcher
+from app.cache import PredictionCache, trip_key
+from app.lookup import LookupTier
+from app.registry import ModelRegistry
+from taxifare import instrumentation
+
+
+WARMUP_TRIP = dict(pickup_datetime='2013-07-06 17:18:00',
+                   pickup_longitude=-73.950655,
+                   pickup_latitude=40.783282,
+                   dropoff_longitude=-73.984365,
+                   dropoff_latitude=40.769802,
+                   passenger_count=1)
+
+
+def warm_up(loaded):
+    """Runs a prediction through both scoring paths of a newly loaded model,
+    before it is swapped in"""
+    X_pred, _, _ = build_batch([WARMUP_TRIP, WARMUP_TRIP])
+    loaded.model.predict(X_pred)
+    if loaded.compiled is not None:
+        loaded.compiled.predict_one(parse_trip(WARMUP_TRIP)[0])
 
 
 api = FastAPI()
+registry = ModelRegistry(warmup=warm_up)
+# set on SIGTERM under gunicorn (app.worker) and at shutdown, so load
+# balancers stop routing to the worker
+draining = False
 
 api.add_middleware(
     CORSMiddleware,
@@ -17,54 +46,156 @@ api.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+if instrumentation.enabled():
+    @api.middleware("http")
+    async def time_requests(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        # per route template, unknown paths are grouped to bound the labels
+        route = request.scope.get('route')
+        instrumentation.observe(f"http {route.path if route else 'unmatched'}",
+                                time.perf_counter() - start)
+        return response
+
+
+@api.on_event("startup")
+async def load_model():
+    registry.start()
+    batcher.start()
+
+
+@api.on_event("shutdown")
+async def stop_model_watcher():
+    global draining
+    draining = True
+    await batcher.stop()
+    registry.stop()
+
+
+def score_trips(trips):
+    """Scores a list or columnar dict of trips with the current model.
+    Returns one {'fare': ...} or {'error': ...} entry per trip, in order.
+    """
+    loaded = registry.get()
+    columns = to_columns(trips)
+    trip = single_trip(columns)
+    if trip is not None and loaded.compiled is not None:
+        # a single row skips pandas entirely
+        with instrumentation.timed('api.parse_trip', 1):
+            row, error = parse_trip(trip)
+        if error:
+            return [{'error': error}]
+        with instrumentation.timed('api.compiled_predict', 1):
+            fare = loaded.compiled.predict_one(row)
+        return [{'fare': float(np.round(fare, 2))}]
+
+    with instrumentation.timed('api.build_batch') as timer:
+        X_pred, valid, errors = build_batch(columns)
+        timer.rows = len(valid)
+    fares = iter([])
+    if len(X_pred):
+        # the pipeline steps are timed by the registry's instrumented copy
+        fares = iter(loaded.model.predict(X_pred).round(2).tolist())
+    return [{'fare': next(fares)} if is_valid else {'error': error}
+            for is_valid, error in zip(valid, errors)]
+
+
+batcher = MicroBatcher(score_trips)
+cache = PredictionCache()
+lookup = LookupTier()
+
+
 # define a root `/` endpoint
 @api.get("/")
 def index():
     return {"Taxi fare prediction API": "Hello"}
 
 
+@api.get("/health/live")
+def live():
+    return {'status': 'ok'}
+
+
+@api.get("/health/ready")
+def ready():
+    """Healthy once a model is loaded and a warm-up prediction succeeded"""
+    if draining or registry.current is None:
+        return JSONResponse(status_code=503, content={'status': 'unavailable'})
+    return {'status': 'ready', 'version': registry.current.version}
+
+
+@api.get("/model/info")
+def model_info():
+    return registry.info()
+
+
+@api.get("/metrics")
+def metrics():
+    """Stage latency histograms and row counts in the Prometheus text
+    format, empty unless TAXIFARE_INSTRUMENT=1"""
+    return PlainTextResponse(instrumentation.prometheus_text(),
+                             media_type='text/plain; version=0.0.4')
+
+
+@api.get("/predict/stats")
+def predict_stats():
+    return {**batcher.stats(), 'cache': cache.stats(), 'lookup': lookup.stats()}
+
+
 @api.get("/predict")
-def predict(pickup_datetime,        # 2013-07-06 17:18:00
-            pickup_longitude,       # -73.950655
-            pickup_latitude,        # 40.783282
-            dropoff_longitude,      # -73.984365
-            dropoff_latitude,       # 40.769802
-            passenger_count):       # 1
-
-
-    # create datetime object from user provided date
-    pickup_datetime = datetime.strptime(pickup_datetime, "%Y-%m-%d %H:%M:%S")
-    # localize the user provided datetime with the NYC timezone
-    eastern = pytz.timezone("US/Eastern")
-    localized_pickup_datetime = eastern.localize(pickup_datetime, is_dst=None)
-    # convert the user datetime to UTC
-    utc_pickup_datetime = localized_pickup_datetime.astimezone(pytz.utc)
-    # format the datetime as expected by the pipeline
-    formatted_pickup_datetime = utc_pickup_datetime.strftime("%Y-%m-%d %H:%M:%S UTC")
-
-    # fixing a value for the key, unused by the model
-    key='2013-07-06 17:18:00.000000119'
-
-    params=dict(key=[key],
-                pickup_datetime=[formatted_pickup_datetime],
-                pickup_longitude=[float(pickup_longitude)],
-                pickup_latitude=[float(pickup_latitude)],
-                dropoff_longitude=[float(dropoff_longitude)],
-                dropoff_latitude=[float(dropoff_latitude)],
-                passenger_count=[int(passenger_count)]
-                )
-    X_pred = pd.DataFrame(params)
-    model = joblib.load(os.path.dirname(__file__) + "/../joblib/model.joblib")
-    fare = float(model.predict(X_pred).round(2))
-    return {'fare': fare}
+async def predict(pickup_datetime,        # 2013-07-06 17:18:00
+                  pickup_longitude,       # -73.950655
+                  pickup_latitude,        # 40.783282
+                  dropoff_longitude,      # -73.984365
+                  dropoff_latitude,       # 40.769802
+                  passenger_count,        # 1
+                  exact: bool = False):
+    """Scores one trip. Trips covered by the precomputed fare table are
+    answered from it unless exact=true. Repeated trips (same rounded
+    coordinates, local hour and passenger count) are answered from the
+    prediction cache, the other concurrent calls are coalesced into a single
+    pipeline call by the micro-batcher.
+    """
+    trip = dict(pickup_datetime=pickup_datetime,
+                pickup_longitude=pickup_longitude,
+                pickup_latitude=pickup_latitude,
+                dropoff_longitude=dropoff_longitude,
+                dropoff_latitude=dropoff_latitude,
+                passenger_count=passenger_count)
+    version = registry.get().version
+    if not exact:
+        result = lookup.get(trip, version)
+        if result is not None:
+            return result
+    key = trip_key(trip, cache.precision)
+    result = cache.get(key, version)
+    if result is None:
+        result = await batcher.submit(trip)
+        if 'error' in result:
+            raise HTTPException(status_code=422, detail=result['error'])
+        cache.put(key, version, result)
+    return result
+
+
+@api.post("/predict/batch")
+def predict_batch(trips: Union[List[Dict[str, Any]], Dict[str, List[Any]]] = Body(...)):
+    """Scores many trips in one vectorized pipeline call. Accepts a list of
+    trips with the same fields as /predict, or a dict with one list per field.
+    Returns one {'fare': ...} or {'error': ...} entry per trip, in order.
+    """
+    try:
+        predictions = score_trips(trips)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {'predictions': predictions}
 
 if __name__ == '__main__':
-    test_fare = predict('2013-07-06 17:18:00',
-                        '-73.950655',
-                        '40.783282',
-                        '-73.984365',
-                        '40.769802',
-                        '1')
+    test_fare = asyncio.run(predict('2013-07-06 17:18:00',
+                                    '-73.950655',
+                                    '40.783282',
+                                    '-73.984365',
+                                    '40.769802',
+                                    '1'))
     print(test_fare)
 
 
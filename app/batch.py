@@ -0,0 +1,113 @@
+import math
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# fixing a value for the key, unused by the model
+KEY = '2013-07-06 17:18:00.000000119'
+COORD_FIELDS = ['pickup_longitude', 'pickup_latitude',
+                'dropoff_longitude', 'dropoff_latitude']
+TRIP_FIELDS = ['pickup_datetime'] + COORD_FIELDS + ['passenger_count']
+
+
+def to_columns(payload):
+    """Turns a list of trips, or a dict with one list per field, into a dict
+    of columns. Missing fields become None so they are reported per row.
+    """
+    if isinstance(payload, dict):
+        n_rows = {len(values) for values in payload.values()}
+        if len(n_rows) > 1:
+            raise ValueError('all columns must have the same length')
+        n_rows = n_rows.pop() if n_rows else 0
+        return {field: list(payload.get(field, [None] * n_rows))
+                for field in TRIP_FIELDS}
+    return {field: [trip.get(field) for trip in payload]
+            for field in TRIP_FIELDS}
+
+
+def single_trip(columns):
+    """Returns the only trip of a dict of columns as a dict, or None"""
+    if len(columns['pickup_datetime']) != 1:
+        return None
+    return {field: values[0] for field, values in columns.items()}
+
+
+def error_message(invalid_fields):
+    if not invalid_fields:
+        return None
+    return f"invalid value for: {', '.join(invalid_fields)}"
+
+
+def localize_pickup_datetime(pickup_datetime, time_zone='US/Eastern'):
+    """Converts local NYC datetimes formatted as "%Y-%m-%d %H:%M:%S" into the
+    UTC strings expected by the pipeline. Unparseable, ambiguous or
+    non-existent local times become NaN.
+    """
+    local = pd.to_datetime(pd.Series(pickup_datetime, dtype=object),
+                           format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    local = local.dt.tz_localize(time_zone, ambiguous='NaT', nonexistent='NaT')
+    return local.dt.tz_convert('UTC').dt.strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+def build_batch(payload):
+    """Validates a batch of trips and returns the DataFrame of valid rows for
+    the pipeline, a boolean mask of valid rows and the per-row error messages
+    (None for valid rows), in the order of the payload.
+    """
+    columns = to_columns(payload)
+    n_rows = len(columns['pickup_datetime'])
+    errors = [[] for _ in range(n_rows)]
+
+    pickup_datetime = localize_pickup_datetime(columns['pickup_datetime'])
+    for i in np.flatnonzero(pickup_datetime.isna().to_numpy()):
+        errors[i].append('pickup_datetime')
+
+    data = dict(pickup_datetime=pickup_datetime)
+    for field in COORD_FIELDS + ['passenger_count']:
+        values = pd.to_numeric(pd.Series(columns[field], dtype=object),
+                               errors='coerce').astype('float64')
+        # NaN, inf and overflowing numbers such as 1e400
+        invalid = ~np.isfinite(values.to_numpy())
+        if field == 'passenger_count':
+            invalid |= values.where(~invalid, 0).to_numpy() % 1 != 0
+        for i in np.flatnonzero(invalid):
+            errors[i].append(field)
+        data[field] = values
+
+    valid = np.array([not row_errors for row_errors in errors], dtype=bool)
+    X_pred = pd.DataFrame(data)[valid]
+    X_pred.insert(loc=0, column='key', value=KEY)
+    X_pred['passenger_count'] = X_pred['passenger_count'].astype(int)
+    return X_pred, valid, [error_message(row_errors) for row_errors in errors]
+
+
+def parse_trip(trip, time_zone='US/Eastern'):
+    """Pure-Python counterpart of build_batch for a single trip dict.
+    Returns the row as a dict with the pipeline's columns and the error
+    message (None if the trip is valid).
+    """
+    invalid = []
+    row = dict(key=KEY, pickup_datetime=None)
+    try:
+        local = datetime.strptime(str(trip.get('pickup_datetime')),
+                                  '%Y-%m-%d %H:%M:%S')
+        local = pytz.timezone(time_zone).localize(local, is_dst=None)
+        row['pickup_datetime'] = local.astimezone(pytz.utc)\
+            .strftime('%Y-%m-%d %H:%M:%S UTC')
+    except (ValueError, pytz.exceptions.InvalidTimeError):
+        invalid.append('pickup_datetime')
+
+    for field in COORD_FIELDS + ['passenger_count']:
+        try:
+            value = float(trip.get(field))
+        except (TypeError, ValueError):
+            value = math.nan
+        if not math.isfinite(value) or \
+                (field == 'passenger_count' and value % 1 != 0):
+            invalid.append(field)
+        row[field] = value
+    if not invalid:
+        row['passenger_count'] = int(row['passenger_count'])
+    return row, error_message(invalid)
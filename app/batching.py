@@ -0,0 +1,144 @@
+import asyncio
+import os
+from collections import Counter
+
+MAX_WAIT_MS = float(os.environ.get('PREDICT_MAX_WAIT_MS', 2))
+MAX_BATCH_SIZE = int(os.environ.get('PREDICT_MAX_BATCH_SIZE', 64))
+
+
+def histogram_bucket(value):
+    """Returns the smallest power of two >= value, used as histogram bucket"""
+    bucket = 1
+    while bucket < value:
+        bucket *= 2
+    return bucket
+
+
+class MicroBatcher():
+    """Coalesces concurrent single-row requests into one batch call.
+
+    Requests are queued; a single consumer task takes everything already
+    waiting, waits up to max_wait_ms for more (until max_batch_size rows),
+    and runs predict_fn on the whole batch in a worker thread. While a batch
+    is running new requests pile up in the queue, so batches grow with load
+    and stay at one row when the server is idle.
+
+    predict_fn takes a list of rows and returns one result per row. When
+    it raises on a batch, the rows are scored one by one so the exception
+    only reaches the requests whose row fails.
+    """
+
+    def __init__(self, predict_fn, max_wait_ms=MAX_WAIT_MS,
+                 max_batch_size=MAX_BATCH_SIZE):
+        self.predict_fn = predict_fn
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self._task = None
+        # rows taken from the queue and not answered yet
+        self._batch = []
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.n_batches = 0
+        self.n_rows = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Starts the consumer task, must be called from the event loop"""
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._consume())
+
+    async def stop(self):
+        """Stops the consumer task, then scores the rows it had not answered
+        yet (the batch it was collecting or running and the queued rows), so
+        no request waits forever at shutdown"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            batch, self._batch = self._batch, []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if batch:
+                await self._score(batch)
+
+    async def submit(self, row):
+        """Queues one row and waits for its result"""
+        if not self.running:
+            return self.predict_fn([row])[0]
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depths[histogram_bucket(self.queue.qsize() + 1)] += 1
+        await self.queue.put((row, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = self._batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _consume(self):
+        while True:
+            batch = await self._collect()
+            self.batch_sizes[histogram_bucket(len(batch))] += 1
+            self.n_batches += 1
+            self.n_rows += len(batch)
+            await self._score(batch)
+            self._batch = []
+
+    async def _score(self, batch):
+        loop = asyncio.get_running_loop()
+        rows = [row for row, _ in batch]
+        try:
+            results = await loop.run_in_executor(None, self.predict_fn, rows)
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch[0][1], exception=e)
+                return
+            # isolate the failing rows so they don't fail the whole batch
+            for row, future in batch:
+                try:
+                    result = await loop.run_in_executor(
+                        None, self.predict_fn, [row])
+                except Exception as row_error:
+                    self._resolve(future, exception=row_error)
+                else:
+                    self._resolve(future, result[0])
+            return
+        for (_, future), result in zip(batch, results):
+            self._resolve(future, result)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        return {'max_wait_ms': self.max_wait_ms,
+                'max_batch_size': self.max_batch_size,
+                'queue_depth': self.queue.qsize() if self.queue else 0,
+                'batches': self.n_batches,
+                'rows': self.n_rows,
+                'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+                'queue_depth_histogram': dict(sorted(self.queue_depths.items()))}
@@ -0,0 +1,117 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from app.batch import COORD_FIELDS
+
+CACHE_SIZE = int(os.environ.get('PREDICT_CACHE_SIZE', 10_000))
+CACHE_TTL = float(os.environ.get('PREDICT_CACHE_TTL', 300))
+# 4 decimals of a degree is about 11 m of latitude in NYC
+CACHE_PRECISION = int(os.environ.get('PREDICT_CACHE_PRECISION', 4))
+
+
+def trip_key(trip, precision=CACHE_PRECISION):
+    """Returns the cache key of a raw /predict trip, or None if the trip
+    cannot be parsed (such trips are never cached).
+
+    The time features only use the local day of week, hour, month and year,
+    so all pickups within the same local hour share a key; coordinates are
+    rounded to `precision` decimals.
+    """
+    try:
+        local = datetime.strptime(str(trip['pickup_datetime']),
+                                  '%Y-%m-%d %H:%M:%S')
+        coords = [float(trip[field]) for field in COORD_FIELDS]
+        passenger_count = float(trip['passenger_count'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if any(math.isnan(value) for value in coords + [passenger_count]):
+        return None
+    return (local.strftime('%Y-%m-%d %H'),
+            *(round(value, precision) for value in coords),
+            passenger_count)
+
+
+class PredictionCache():
+    """Bounded LRU cache of predictions with a time to live.
+
+    Entries are tied to the model version they were computed with: the
+    first lookup made with a new version empties the cache, and results
+    computed with a replaced model are not stored, so a reloaded model never
+    serves stale fares. A capacity of 0 disables the cache.
+    """
+
+    def __init__(self, capacity=CACHE_SIZE, ttl=CACHE_TTL,
+                 precision=CACHE_PRECISION):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.precision = precision
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """Returns the cached result for key, or None"""
+        if key is None or not self.enabled:
+            return None
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, result):
+        if key is None or not self.enabled:
+            return
+        with self._lock:
+            if version != self.version:
+                # computed with a model that has been replaced since
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'enabled': self.enabled,
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'precision': self.precision,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
@@ -0,0 +1,127 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# point GEOCODE_URL at a local stub server to develop without Nominatim
+GEOCODE_URL = os.environ.get('GEOCODE_URL',
+                             'https://nominatim.openstreetmap.org/search')
+GEOCODE_CACHE_PATH = os.environ.get(
+    'GEOCODE_CACHE_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'raw_data', 'geocode.sqlite'))
+GEOCODE_TTL = float(os.environ.get('GEOCODE_TTL', 7 * 24 * 3600))
+GEOCODE_MAX_ENTRIES = int(os.environ.get('GEOCODE_MAX_ENTRIES', 10_000))
+USER_AGENT = 'taxifare-streamlit'
+
+
+def normalize_address(address):
+    """Lower case, trimmed, single spaced address used as cache key"""
+    return re.sub(r'\s+', ' ', address or '').strip().lower()
+
+
+class GeocodeCache():
+    """Geocoding responses cached in memory and in a SQLite file.
+
+    Entries expire after ttl seconds; once more than max_entries are stored
+    the least recently written ones are deleted. The SQLite file lets the
+    cache survive restarts and be shared by several Streamlit processes.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_TTL,
+                 max_entries=GEOCODE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = {}
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS geocode '
+                         '(address TEXT PRIMARY KEY, response TEXT, '
+                         'created REAL)')
+        self._db.commit()
+
+    def get(self, address):
+        """Returns the cached response for a normalized address, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(address)
+            if entry is None:
+                entry = self._db.execute(
+                    'SELECT created, response FROM geocode WHERE address = ?',
+                    (address,)).fetchone()
+                if entry is not None:
+                    entry = (entry[0], json.loads(entry[1]))
+                    self._memory[address] = entry
+            if entry is None or now - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, address, response):
+        created = time.time()
+        with self._lock:
+            self._memory[address] = (created, response)
+            self._db.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)',
+                             (address, json.dumps(response), created))
+            self._db.execute('DELETE FROM geocode WHERE created < ?',
+                             (created - self.ttl,))
+            self._db.execute(
+                'DELETE FROM geocode WHERE address NOT IN (SELECT address FROM '
+                'geocode ORDER BY created DESC LIMIT ?)', (self.max_entries,))
+            self._db.commit()
+            if len(self._memory) > self.max_entries:
+                oldest = sorted(self._memory, key=lambda a: self._memory[a][0])
+                for key in oldest[:len(self._memory) - self.max_entries]:
+                    del self._memory[key]
+
+
+class Geocoder():
+    """Looks addresses up through a pooled HTTP session, several at a time,
+    and caches the responses"""
+
+    def __init__(self, url=GEOCODE_URL, cache=None, max_workers=4, timeout=10):
+        self.url = url
+        self.cache = cache if cache is not None else GeocodeCache()
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def search(self, address):
+        """Returns the list of places found for the address"""
+        address = normalize_address(address)
+        if address == '':
+            return []
+        response = self.cache.get(address)
+        if response is None:
+            response = self.session.get(
+                self.url, params={'q': address, 'format': 'json'},
+                timeout=self.timeout)
+            response.raise_for_status()
+            response = response.json()
+            self.cache.put(address, response)
+        return response
+
+    def search_many(self, addresses):
+        """Looks the addresses up concurrently, results in the same order"""
+        return list(self.executor.map(self.search, addresses))
+
+
+if __name__ == "__main__":
+    geocoder = Geocoder(cache=GeocodeCache(':memory:'))
+    for attempt in range(2):
+        start = time.perf_counter()
+        results = geocoder.search_many(['empire state building, new york',
+                                        'jfk airport, new york'])
+        print(f'{time.perf_counter() - start:.3f}s',
+              [len(result) for result in results])
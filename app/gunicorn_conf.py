@@ -0,0 +1,26 @@
+# Production serving: gunicorn -c app/gunicorn_conf.py app.api:api
+#
+# The app and its model are loaded once in the master process, then the
+# workers are forked from it, so the model pages are shared copy-on-write
+# (and, for flat artifacts, memory-mapped from the page cache) instead of
+# being loaded once per worker. `kill -HUP <master pid>` starts new workers
+# and lets the old ones finish their in-flight requests before exiting.
+# A worker receiving SIGTERM first answers 503 on /health/ready for
+# DRAIN_SECONDS while still serving (see app/worker.py).
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'app.worker.DrainingUvicornWorker'
+preload_app = True
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = 60
+
+
+def when_ready(server):
+    # runs in the master after the app is imported and before the workers
+    # are forked
+    from app.api import registry
+    registry.get()
+    server.log.info(f'model {registry.current.version} loaded before fork')
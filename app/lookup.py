@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+from app.batch import parse_trip
+from taxifare.lookup import LOOKUP_PATH, FareTable, read_manifest
+
+# how often the table manifest is read again for a new build
+LOOKUP_POLL_INTERVAL = float(os.environ.get('LOOKUP_POLL_INTERVAL', 5))
+
+
+class LookupTier():
+    """Serves /predict from a precomputed FareTable (see taxifare.lookup).
+
+    The table is only used while it was built for the model version being
+    served, i.e. while the model_version of its manifest (path) is the
+    registry's version of the model file, see app.registry. The manifest is
+    read again every poll_interval seconds and the table is reloaded when
+    its model version or build changes, so a table rebuilt after a model
+    reload is picked up without a restart, and a table copied to another
+    machine is not reloaded for nothing. get returns None for the trips the
+    table does not cover, which are scored by the model.
+    """
+
+    def __init__(self, path=LOOKUP_PATH, poll_interval=LOOKUP_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.table = None
+        self._stamp = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def current(self, version):
+        '''the table if it matches the model version, reloading it when a
+        new one was published'''
+        if time.monotonic() - self._checked >= self.poll_interval:
+            self._poll()
+        table = self.table
+        return table if table is not None and table.model_version == version \
+            else None
+
+    def _poll(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked < self.poll_interval:
+                return
+            self._checked = now
+            try:
+                meta = read_manifest(self.path)
+                stamp = (meta.get('model_version'), meta['build_id'])
+                if stamp != self._stamp:
+                    self.table = FareTable.load(self.path, meta)
+                    self._stamp = stamp
+            except (OSError, KeyError, ValueError) as e:
+                if self._stamp is not None:
+                    print(f'fare table unavailable: {e!r}')
+                self.table, self._stamp = None, None
+
+    def get(self, trip, version):
+        """Returns {'fare': ...} for a raw /predict trip from the table, or
+        None when there is no usable table, the trip is invalid (the model
+        path reports the error) or outside the table"""
+        table = self.current(version)
+        if table is None:
+            return None
+        row, error = parse_trip(trip)
+        fare = None
+        if error is None:
+            local = datetime.strptime(str(trip['pickup_datetime']),
+                                      '%Y-%m-%d %H:%M:%S')
+            fare = table.lookup(row['pickup_latitude'], row['pickup_longitude'],
+                                row['dropoff_latitude'], row['dropoff_longitude'],
+                                local)
+        if fare is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {'fare': round(fare, 2)}
+
+    def stats(self):
+        table = self.table
+        return {'loaded': table is not None,
+                'resolution': table.resolution if table is not None else None,
+                'model_version': table.model_version if table is not None else None,
+                'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from taxifare import instrumentation
+from taxifare.artifacts import load_artifact
+from taxifare.compiled import compile_pipeline
+
+MODEL_PATH = os.environ.get(
+    'MODEL_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'joblib', 'model.joblib'))
+POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', 5))
+
+LoadedModel = namedtuple('LoadedModel',
+                         ['model', 'compiled', 'version', 'load_seconds',
+                          'loaded_at'])
+
+
+class ModelRegistry():
+    """Keeps the fitted pipeline in memory and hot-swaps it when the file changes.
+
+    The loaded pipeline and its metadata are held in a single LoadedModel
+    tuple which is replaced in one assignment, so a request that already
+    grabbed the current model keeps using it until it is done.
+    warmup is called with each new LoadedModel before it is swapped in.
+
+    The arrays of the model are memory-mapped, so each version is first
+    copied to a snapshot file of its own (shared by the workers of a
+    server): overwriting the model file in place, e.g. with cp or
+    joblib.dump, then cannot corrupt the model being served.
+    """
+
+    def __init__(self, path=MODEL_PATH, poll_interval=POLL_INTERVAL,
+                 warmup=None):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.warmup = warmup
+        self.current = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def file_version(self):
+        """Returns the version tag of the model file on disk.
+        A `<path>.version` file takes precedence over the modification time.
+        """
+        tag_file = f'{self.path}.version'
+        if os.path.isfile(tag_file):
+            with open(tag_file) as f:
+                return f.read().strip()
+        return str(os.stat(self.path).st_mtime_ns)
+
+    @property
+    def snapshot_dir(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                            '.snapshots')
+
+    def snapshot(self, version):
+        """Copies the model file to a snapshot named after its version and
+        file stamp unless another process already did, removes the older
+        snapshots and returns its path. Removing a snapshot still mapped by
+        another process is safe, its pages stay valid until unmapped."""
+        stat = os.stat(self.path)
+        stamp = f'{version}:{stat.st_size}:{stat.st_mtime_ns}'
+        prefix = f'{os.path.basename(self.path)}.'
+        name = prefix + hashlib.sha1(stamp.encode()).hexdigest()[:16]
+        path = os.path.join(self.snapshot_dir, name)
+        if not os.path.isfile(path):
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            shutil.copyfile(self.path, tmp)
+            os.replace(tmp, path)
+        for other in os.listdir(self.snapshot_dir):
+            if other.startswith(prefix) and other != name and \
+                    not other.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.snapshot_dir, other))
+                except OSError:
+                    pass
+        return path
+
+    def load(self):
+        """Loads the model from disk and swaps it in"""
+        with self._load_lock:
+            version = self.file_version()
+            start = time.perf_counter()
+            model = load_artifact(self.snapshot(version), mmap_mode='r')
+            load_seconds = time.perf_counter() - start
+            compiled = compile_pipeline(model)
+            if instrumentation.enabled():
+                model = instrumentation.instrument_pipeline(model)
+            loaded = LoadedModel(model, compiled, version, load_seconds,
+                                 datetime.utcnow().isoformat())
+            if self.warmup is not None:
+                self.warmup(loaded)
+            self.current = loaded
+        return self.current
+
+    def get(self):
+        """Returns the current LoadedModel, loading it on first use"""
+        current = self.current
+        if current is None:
+            current = self.load()
+        return current
+
+    def reload_if_changed(self):
+        """Reloads the model when the version on disk differs from the loaded one"""
+        try:
+            version = self.file_version()
+        except OSError:
+            # file is being replaced, keep serving the current model
+            return False
+        if self.current is not None and version == self.current.version:
+            return False
+        self.load()
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                print(f'model reload failed, keeping current model: {e!r}')
+
+    def start(self):
+        """Loads the model and starts the background watcher thread"""
+        self.get()
+        if self.poll_interval > 0 and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def info(self):
+        current = self.get()
+        return {'path': os.path.abspath(self.path),
+                'version': current.version,
+                'load_seconds': current.load_seconds,
+                'compiled': current.compiled is not None,
+                'loaded_at': current.loaded_at}
@@ -4,9 +4,10 @@ import os
 import joblib
 import pandas as pd
 import pytz
-import requests
 import streamlit as st
 
+from app.geocode import Geocoder
+
 '''
 # Taxi Fare Predictor (New York City)
 '''
@@ -18,13 +19,24 @@ CSS = """
 st.write(f'<style>{CSS}</style>', unsafe_allow_html=True)
 
 
-def address_coord(entered_address):
+# kept across reruns, Streamlit reruns the whole script on every widget change
+cache_resource = getattr(st, 'cache_resource', None) or st.experimental_singleton
+
+
+@cache_resource
+def get_geocoder():
+    return Geocoder()
+
+
+@cache_resource
+def get_model():
+    return joblib.load(os.path.dirname(__file__) + "/../joblib/model.joblib")
+
+
+def address_coord(entered_address, response):
     """Checks whether the address entered is valid and extracts the
-    coordinates through an API
+    coordinates from the geocoding response
     """
-    api_url = 'https://nominatim.openstreetmap.org/search'
-    response = requests.get(api_url, params={'q':entered_address,
-                                                'format':'json'}).json()
 
     # Check if address is in New York and append the correct addresses to new_york
     new_york = []
@@ -65,11 +77,13 @@ time = columns[1].time_input('Enter time', datetime.time(12, 00))
 date_and_time = datetime.datetime.combine(date, time)
 passenger_count = columns[2].selectbox('Number of passengers', list(range(1, 9)))
 
-# Obtaining coordinates for pickup and dropoff address
+# Obtaining coordinates for pickup and dropoff address, both looked up at once
 pickup_address = st.text_input('Enter pickup address').strip().lower()
-pickup_longitude, pickup_latitude = address_coord(pickup_address)
 dropoff_address = st.text_input('Enter dropoff address').strip().lower()
-dropoff_longitude, dropoff_latitude = address_coord(dropoff_address)
+pickup_response, dropoff_response = get_geocoder().search_many(
+    [pickup_address, dropoff_address])
+pickup_longitude, pickup_latitude = address_coord(pickup_address, pickup_response)
+dropoff_longitude, dropoff_latitude = address_coord(dropoff_address, dropoff_response)
 
 col1, col2, col3 = st.columns(3)
 predict_button = col2.button('Predict Taxi Fare')
@@ -110,7 +124,7 @@ if predict_button:
         key='2013-07-06 17:18:00.000000119'
         X_pred = pd.DataFrame(params, index=[0])
         X_pred.insert(loc=0, column='key', value=key)
-        model = joblib.load(os.path.dirname(__file__) + "/../joblib/model.joblib")
+        model = get_model()
         fare = float(model.predict(X_pred).round(2))
         st.markdown(f'## Predicted fare: `{fare}`')
 
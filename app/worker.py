@@ -0,0 +1,42 @@
+import os
+import signal
+import sys
+import threading
+
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn.workers import UvicornWorker
+
+# how long a worker keeps serving with /health/ready at 503 after SIGTERM,
+# so load balancers stop routing to it before it stops accepting requests;
+# must stay below gunicorn's graceful_timeout
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', 5))
+
+
+class DrainingServer(Server):
+    """uvicorn Server which, on the first SIGTERM, only marks the app as
+    draining and starts shutting down DRAIN_SECONDS later. uvicorn closes
+    its sockets as soon as handle_exit is called, which is too late for
+    the readiness probe to report it."""
+
+    def handle_exit(self, sig, frame):
+        import app.api
+
+        if sig != signal.SIGTERM or app.api.draining or DRAIN_SECONDS <= 0:
+            return super().handle_exit(sig, frame)
+        app.api.draining = True
+        timer = threading.Timer(DRAIN_SECONDS, super().handle_exit, (sig, frame))
+        timer.daemon = True
+        timer.start()
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    """UvicornWorker serving with DrainingServer, see app/gunicorn_conf.py.
+    _serve is the coroutine UvicornWorker.run serves the app with."""
+
+    async def _serve(self):
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
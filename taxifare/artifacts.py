@@ -0,0 +1,179 @@
+import multiprocessing
+import os
+import time
+import warnings
+
+import joblib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.pipeline import Pipeline
+
+ARTIFACT_FORMATS = ('joblib', 'compressed', 'flat')
+
+
+class FlatForestRegressor(BaseEstimator, RegressorMixin):
+    """Array-based copy of a fitted tree ensemble for fast, shareable loading.
+
+    The nodes of all trees are concatenated into a few flat arrays with
+    float32 thresholds and leaf values. Unlike sklearn trees, which copy
+    their nodes into their own memory when unpickled, these arrays stay
+    memory-mapped when loaded with joblib.load(mmap_mode='r'), so several
+    server processes share one copy in the page cache.
+    """
+
+    def __init__(self, roots=None, left=None, right=None, feature=None,
+                 threshold=None, value=None):
+        self.roots = roots
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        """Flattens a fitted DecisionTreeRegressor, RandomForestRegressor or
+        ExtraTreesRegressor with a single output"""
+        # only needed to flatten, loading a flat artifact does not use them
+        from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+        from sklearn.tree import DecisionTreeRegressor
+
+        if isinstance(estimator, DecisionTreeRegressor):
+            trees = [estimator.tree_]
+        elif isinstance(estimator, (RandomForestRegressor, ExtraTreesRegressor)):
+            trees = [tree.tree_ for tree in estimator.estimators_]
+        else:
+            raise ValueError(f'cannot flatten {estimator!r}')
+        if trees[0].n_outputs != 1:
+            raise ValueError('only single output trees can be flattened')
+
+        sizes = np.array([tree.node_count for tree in trees])
+        roots = np.r_[0, np.cumsum(sizes)[:-1]].astype('int32')
+        left, right, feature, threshold, value = [], [], [], [], []
+        for root, tree in zip(roots, trees):
+            is_leaf = tree.children_left == -1
+            # leaves point to themselves so the traversal can run a fixed
+            # number of steps
+            own = root + np.arange(tree.node_count)
+            left.append(np.where(is_leaf, own, root + tree.children_left))
+            right.append(np.where(is_leaf, own, root + tree.children_right))
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            # round thresholds down to float32: inputs are compared as float32
+            # by sklearn, so x <= t and x <= float32_down(t) always agree
+            t32 = tree.threshold.astype('float32')
+            t32 = np.where(t32 > tree.threshold,
+                           np.nextafter(t32, np.float32(-np.inf)), t32)
+            threshold.append(t32)
+            value.append(tree.value[:, 0, 0].astype('float32'))
+        return cls(roots=roots,
+                   left=np.concatenate(left).astype('int32'),
+                   right=np.concatenate(right).astype('int32'),
+                   feature=np.concatenate(feature).astype('int32'),
+                   threshold=np.concatenate(threshold),
+                   value=np.concatenate(value))
+
+    def fit(self, X, y=None):
+        return self
+
+    def predict(self, X, batch_size=10_000):
+        n_rows = X.shape[0]
+        y_pred = np.empty(n_rows)
+        for start in range(0, n_rows, batch_size):
+            batch = X[start:start + batch_size]
+            batch = batch.toarray() if sp.issparse(batch) else np.asarray(batch)
+            batch = batch.astype('float32')
+            rows = np.arange(len(batch))[:, None]
+            nodes = np.broadcast_to(self.roots, (len(batch), len(self.roots)))
+            while True:
+                go_left = batch[rows, self.feature[nodes]] <= self.threshold[nodes]
+                children = np.where(go_left, self.left[nodes], self.right[nodes])
+                if np.array_equal(children, nodes):
+                    break
+                nodes = children
+            y_pred[start:start + batch_size] = self.value[nodes].mean(axis=1)
+        return y_pred
+
+
+def flatten_pipeline(pipeline):
+    """Returns a copy of the pipeline with its final tree ensemble flattened"""
+    steps = pipeline.steps[:-1] + [
+        ('flatforestregressor', FlatForestRegressor.from_estimator(pipeline.steps[-1][1]))]
+    return Pipeline(steps)
+
+
+def save_artifact(pipeline, path, artifact='joblib'):
+    """Saves a fitted pipeline as a plain joblib dump, a zlib compressed
+    dump (smallest file, cannot be memory-mapped) or a flat dump whose tree
+    arrays can be memory-mapped (see FlatForestRegressor)"""
+    if artifact == 'joblib':
+        joblib.dump(pipeline, path)
+    elif artifact == 'compressed':
+        joblib.dump(pipeline, path, compress=('zlib', 3))
+    elif artifact == 'flat':
+        joblib.dump(flatten_pipeline(pipeline), path)
+    else:
+        raise ValueError(f'artifact should be one of {ARTIFACT_FORMATS}')
+    return path
+
+
+def load_artifact(path, mmap_mode='r'):
+    """Loads any of the artifact formats, memory-mapping the arrays of
+    uncompressed files"""
+    with warnings.catch_warnings():
+        # compressed files are loaded in memory, which is expected here
+        warnings.filterwarnings('ignore', message='.*mmap_mode.*')
+        return joblib.load(path, mmap_mode=mmap_mode)
+
+
+def current_rss():
+    """Resident set size of the current process in bytes (Linux only)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure_load(queue, path, mmap_mode):
+    # import what the pipeline needs first so only the load itself is measured
+    import sklearn.compose  # noqa: F401
+    import sklearn.preprocessing  # noqa: F401
+    import taxifare.encoders  # noqa: F401
+    rss = current_rss()
+    start = time.perf_counter()
+    pipeline = load_artifact(path, mmap_mode)
+    load_seconds = time.perf_counter() - start
+    queue.put((load_seconds, current_rss() - rss))
+    del pipeline
+
+
+def compare_artifacts(pipeline, X, directory='joblib'):
+    """Saves the pipeline in every format and returns, for each, the file
+    size, the load time and RSS increase of a fresh process loading it, and
+    the max absolute prediction difference with the original pipeline"""
+    expected = pipeline.predict(X)
+    results = []
+    for artifact in ARTIFACT_FORMATS:
+        path = save_artifact(pipeline, os.path.join(directory, f'compare_{artifact}.joblib'),
+                             artifact)
+        # a spawned process does not inherit this one's heap, whose free
+        # memory would hide the allocations made by the load
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue()
+        process = context.Process(target=_measure_load, args=(queue, path, 'r'))
+        process.start()
+        load_seconds, rss = queue.get()
+        process.join()
+        max_difference = np.abs(load_artifact(path).predict(X) - expected).max()
+        results.append(dict(artifact=artifact, size_mb=os.path.getsize(path) / 1e6,
+                            load_seconds=load_seconds, rss_mb=rss / 1e6,
+                            max_abs_difference=float(max_difference)))
+        os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    from taxifare.data import get_data, clean_df
+
+    pipeline = joblib.load('joblib/model.joblib')
+    X = clean_df(get_data(nrows=1000)).drop('fare_amount', axis=1)
+    for result in compare_artifacts(pipeline, X):
+        print(result)
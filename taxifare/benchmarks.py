@@ -0,0 +1,473 @@
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from taxifare.data import CSV_DTYPES, clean_df
+from taxifare.encoders import NYC_CENTER
+from taxifare.utils import (distance_features, local_time_features,
+                            parse_utc_seconds)
+
+
+def make_trips(n_rows, seed=0, invalid_fraction=0.02):
+    '''returns a synthetic DataFrame with the train.csv columns, pickups and
+    dropoffs inside the box kept by clean_df and invalid_fraction of the
+    rows pushed outside of it'''
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('2009-01-01T00:00:00', 's').astype('int64')
+    stop = np.datetime64('2015-07-01T00:00:00', 's').astype('int64')
+    seconds = rng.integers(start, stop, n_rows).astype('datetime64[s]')
+    pickup_datetime = pd.Series(np.datetime_as_string(seconds, unit='s'))\
+        .str.replace('T', ' ') + ' UTC'
+    df = pd.DataFrame(dict(
+        key=pickup_datetime.str[:19] + '.' + pd.Series(np.arange(n_rows)).astype(str),
+        fare_amount=rng.gamma(2, 5, n_rows).round(2),
+        pickup_datetime=pickup_datetime,
+        pickup_longitude=rng.uniform(-74.05, -73.75, n_rows),
+        pickup_latitude=rng.uniform(40.6, 40.9, n_rows),
+        dropoff_longitude=rng.uniform(-74.0, -73.75, n_rows),
+        dropoff_latitude=rng.uniform(40.6, 40.9, n_rows),
+        passenger_count=rng.integers(1, 7, n_rows)))
+    invalid = rng.random(n_rows) < invalid_fraction
+    df.loc[invalid, 'pickup_latitude'] = 0
+    return df
+
+
+def clean_df_sequential(df):
+    '''clean_df as it was before the rules rewrite, one filtered copy per
+    filter, kept as the reference for bench_clean_df'''
+    df = df.dropna(how='any', axis='rows')
+    df = df[(df.dropoff_latitude != 0) | (df.dropoff_longitude != 0)]
+    df = df[(df.pickup_latitude != 0) | (df.pickup_longitude != 0)]
+    df = df[(df['pickup_latitude'] != df['dropoff_latitude']) & \
+            (df['pickup_longitude'] != df['dropoff_longitude'])]
+    if "fare_amount" in list(df):
+        df = df[df['fare_amount'].between(0, 4000, inclusive='right')]
+    df = df[df.passenger_count <= 8]
+    df = df[df.passenger_count > 0]
+    df = df[df["pickup_latitude"].between(left=40, right=42)]
+    df = df[df["pickup_longitude"].between(left=-74.3, right=-72.9)]
+    df = df[df["dropoff_latitude"].between(left=40, right=42)]
+    df = df[df["dropoff_longitude"].between(left=-74, right=-72.9)]
+    return df
+
+
+def measure(func, *args, **kwargs):
+    '''returns the result, wall time in seconds and peak traced memory in
+    bytes allocated while running func'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_clean_df(sizes=(1_000_000, 10_000_000)):
+    results = []
+    for n_rows in sizes:
+        df = make_trips(n_rows)
+        for name, func in [('sequential', clean_df_sequential),
+                           ('single_mask', clean_df)]:
+            cleaned, seconds, peak = measure(func, df)
+            results.append(dict(n_rows=n_rows, version=name,
+                                rows_kept=len(cleaned), seconds=seconds,
+                                peak_mb=peak / 1e6))
+            print(results[-1])
+        del df
+    return results
+
+
+def pandas_time_features(pickup_datetime, time_zone_name='America/New_York'):
+    '''reference implementation of the time features with pd.to_datetime'''
+    local = pd.DatetimeIndex(pd.to_datetime(pickup_datetime))\
+        .tz_convert(time_zone_name)
+    return np.column_stack([local.weekday, local.hour, local.month, local.year])
+
+
+def dst_boundary_datetimes(years=range(2008, 2017), time_zone_name='America/New_York'):
+    '''UTC strings every minute for three hours around each DST transition
+    of the given years, plus the new year boundaries'''
+    transitions = pd.DatetimeIndex([
+        t for t in pd.date_range(f'{years[0]}-01-01', f'{years[-1] + 1}-01-01',
+                                 freq='h', tz=time_zone_name)
+        if t.dst() != (t - pd.Timedelta(hours=1)).dst()] +
+        [pd.Timestamp(f'{year}-01-01', tz=time_zone_name) for year in years])
+    minutes = pd.timedelta_range('-3h', '3h', freq='min')
+    stamps = (transitions.tz_convert('UTC').values[:, None] + minutes.values).ravel()
+    return pd.Series(pd.DatetimeIndex(stamps).strftime('%Y-%m-%d %H:%M:%S UTC'))
+
+
+def check_time_features_parity(n_rows=100_000, time_zone_name='America/New_York'):
+    '''returns the number of rows where the fast parser and offset table
+    disagree with pandas, on DST boundaries and random datetimes'''
+    pickup_datetime = pd.concat([dst_boundary_datetimes(time_zone_name=time_zone_name),
+                                 make_trips(n_rows)['pickup_datetime']])
+    expected = pandas_time_features(pickup_datetime, time_zone_name)
+    actual = local_time_features(parse_utc_seconds(pickup_datetime), time_zone_name)
+    return int((expected != actual).any(axis=1).sum())
+
+
+def bench_time_features(sizes=(1_000_000,)):
+    results = []
+    for n_rows in sizes:
+        pickup_datetime = make_trips(n_rows)['pickup_datetime']
+        for name, func in [
+                ('pandas', pandas_time_features),
+                ('fixed_format', lambda values: local_time_features(
+                    parse_utc_seconds(values), 'America/New_York'))]:
+            _, seconds, peak = measure(func, pickup_datetime)
+            results.append(dict(n_rows=n_rows, version=name, seconds=seconds,
+                                peak_mb=peak / 1e6))
+            print(results[-1])
+    return results
+
+
+def make_coordinates(n_rows, seed=0):
+    '''returns pickup and dropoff coordinates with the dtypes get_data reads
+    them with, cheaper to build than make_trips for large sizes'''
+    rng = np.random.default_rng(seed)
+    columns = ['pickup_latitude', 'pickup_longitude',
+               'dropoff_latitude', 'dropoff_longitude']
+    bounds = [(40.6, 40.9), (-74.05, -73.75), (40.6, 40.9), (-74.0, -73.75)]
+    return pd.DataFrame({column: rng.uniform(low, high, n_rows)
+                         .astype(CSV_DTYPES[column])
+                         for column, (low, high) in zip(columns, bounds)})
+
+
+def haversine_reference(df, start_lat, start_lon, end_lat, end_lon):
+    '''haversine_vectorized as it was before the array kernel'''
+    lat_1_rad, lon_1_rad = np.radians(df[start_lat].astype(float)),\
+        np.radians(df[start_lon].astype(float))
+    lat_2_rad, lon_2_rad = np.radians(df[end_lat].astype(float)),\
+        np.radians(df[end_lon].astype(float))
+    dlon = lon_2_rad - lon_1_rad
+    dlat = lat_2_rad - lat_1_rad
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat_1_rad) * np.cos(lat_2_rad) *\
+        np.sin(dlon / 2.0) ** 2
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+
+def distance_features_reference(df):
+    '''the three distance features as DistanceTransformer and
+    DistanceToCenter computed them before: three separate passes, the center
+    broadcast as two constant columns'''
+    df = df.copy()
+    df['nyc_lat'], df['nyc_lng'] = NYC_CENTER
+    return np.column_stack([
+        haversine_reference(df, 'pickup_latitude', 'pickup_longitude',
+                            'dropoff_latitude', 'dropoff_longitude'),
+        haversine_reference(df, 'nyc_lat', 'nyc_lng',
+                            'pickup_latitude', 'pickup_longitude'),
+        haversine_reference(df, 'nyc_lat', 'nyc_lng',
+                            'dropoff_latitude', 'dropoff_longitude')])
+
+
+def bench_haversine(sizes=(1_000_000, 10_000_000, 50_000_000),
+                    reference_max_rows=10_000_000):
+    '''times the three distance features with the previous implementation
+    (up to reference_max_rows, its temporaries do not fit in memory much
+    beyond) and the fused kernel in float64 and float32; max_abs_difference
+    is in km against the fused float64 result'''
+    results = []
+    for n_rows in sizes:
+        df = make_coordinates(n_rows)
+        columns = [df[column].to_numpy() for column in
+                   ['pickup_latitude', 'pickup_longitude',
+                    'dropoff_latitude', 'dropoff_longitude']]
+        versions = [('fused_float64', lambda df: distance_features(
+                        *columns, NYC_CENTER)),
+                    ('fused_float32', lambda df: distance_features(
+                        *columns, NYC_CENTER, dtype=np.float32))]
+        if n_rows <= reference_max_rows:
+            versions.append(('reference', distance_features_reference))
+        expected = None
+        for name, func in versions:
+            features, seconds, peak = measure(func, df)
+            if expected is None:
+                expected = features
+            difference = float(np.abs(features - expected).max())
+            del features
+            results.append(dict(n_rows=n_rows, version=name, seconds=seconds,
+                                peak_mb=peak / 1e6,
+                                max_abs_difference=difference))
+            print(results[-1])
+    return results
+
+
+PREDICT_PARAMS = dict(pickup_datetime='2013-07-06 17:18:00',
+                      pickup_longitude=-73.950655,
+                      pickup_latitude=40.783282,
+                      dropoff_longitude=-73.984365,
+                      dropoff_latitude=40.769802,
+                      passenger_count=1)
+REPO_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+
+def wait_until_ready(url, timeout=120):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{url}/health/ready').status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f'{url} not ready after {timeout} s')
+
+
+def _load_client(url, duration):
+    import requests
+    session = requests.Session()
+    latencies = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        session.get(f'{url}/predict', params=PREDICT_PARAMS).raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_serving(workers=None, duration=10, clients=16, port=8765):
+    '''starts the gunicorn entry point (app/gunicorn_conf.py) with each
+    number of workers (default 1 to the CPU count) and measures /predict
+    throughput and latency with concurrent client processes'''
+    url = f'http://127.0.0.1:{port}'
+    results = []
+    for n_workers in workers or range(1, (os.cpu_count() or 1) + 1):
+        env = dict(os.environ, WEB_CONCURRENCY=str(n_workers), PORT=str(port),
+                   MODEL_POLL_INTERVAL='0')
+        server = subprocess.Popen(
+            ['gunicorn', '-c', 'app/gunicorn_conf.py', 'app.api:api'],
+            cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(url)
+            with ProcessPoolExecutor(clients) as pool:
+                latencies = np.concatenate(list(pool.map(
+                    _load_client, [url] * clients, [duration] * clients)))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        results.append(dict(workers=n_workers, requests=len(latencies),
+                            requests_per_second=len(latencies) / duration,
+                            p50_ms=np.percentile(latencies, 50) * 1000,
+                            p99_ms=np.percentile(latencies, 99) * 1000))
+        print(results[-1])
+    return results
+
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import app.api as api
+imported = time.perf_counter()
+api.registry.poll_interval = 0
+api.registry.load()
+loaded = time.perf_counter()
+api.score_trips([dict(%r)])
+predicted = time.perf_counter()
+print(imported - start, loaded - imported, predicted - loaded, len(sys.modules),
+      int('mlflow' in sys.modules))
+"""
+CLI_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import taxifare.main
+print(time.perf_counter() - start, len(sys.modules), int('mlflow' in sys.modules))
+"""
+
+
+def bench_startup(repeat=5):
+    '''cold start of the API in fresh interpreters: import of app.api, model
+    load and first prediction, plus the import of the training CLI
+    (taxifare.main); medians of repeat runs'''
+    def run(script):
+        output = subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True,
+                                env=dict(os.environ, MODEL_POLL_INTERVAL='0'))
+        return [float(value) for value in output.stdout.split()[-5:]]
+
+    api_runs = np.array([run(STARTUP_SCRIPT % PREDICT_PARAMS)
+                         for _ in range(repeat)])
+    cli_runs = np.array([run(CLI_SCRIPT) for _ in range(repeat)])
+    api_import, load, first_prediction, modules, mlflow = np.median(api_runs, axis=0)
+    cli_import, cli_modules, cli_mlflow = np.median(cli_runs, axis=0)[-3:]
+    result = dict(api_import_seconds=api_import, model_load_seconds=load,
+                  first_prediction_seconds=first_prediction,
+                  api_total_seconds=api_import + load + first_prediction,
+                  api_modules=int(modules), api_imports_mlflow=bool(mlflow),
+                  cli_import_seconds=cli_import, cli_modules=int(cli_modules),
+                  cli_imports_mlflow=bool(cli_mlflow))
+    print(result)
+    return result
+
+
+SUITE_SIZES = (10_000, 1_000_000, 10_000_000)
+SUITE_OUTPUT = os.environ.get('BENCHMARK_OUTPUT', 'benchmark_results.json')
+# a stage regresses when its time or peak memory grows by more than this
+REGRESSION_THRESHOLD = 0.10
+
+
+def environment():
+    '''versions and machine details stored with the suite results'''
+    import sklearn
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                pandas=pd.__version__, sklearn=sklearn.__version__,
+                machine=platform.machine(), cpu_count=os.cpu_count())
+
+
+def bench_predict(model_path, trips, n_requests=500, concurrency=8):
+    '''/predict latency (one request at a time) and throughput (concurrency
+    threads) through the FastAPI test client, with the prediction cache off'''
+    from fastapi.testclient import TestClient
+    from app import api as api_module
+
+    api_module.registry.path = model_path
+    api_module.registry.poll_interval = 0
+    api_module.registry.current = None
+    api_module.cache.capacity = 0
+    params = [dict(trip) for trip in trips]
+
+    def get(i):
+        start = time.perf_counter()
+        response = client.get('/predict', params=params[i % len(params)])
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    with TestClient(api_module.api) as client:
+        latencies = np.array([get(i) for i in range(n_requests)])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(get, range(n_requests)))
+        seconds = time.perf_counter() - start
+    return dict(p50_ms=np.percentile(latencies, 50) * 1000,
+                p95_ms=np.percentile(latencies, 95) * 1000,
+                p99_ms=np.percentile(latencies, 99) * 1000,
+                requests_per_second=n_requests / seconds)
+
+
+def run_suite(sizes=SUITE_SIZES, model=None, seed=0):
+    '''times and measures the peak memory of the data, feature, training and
+    serving hot paths on synthetic trips of each size. Returns a dict with
+    the environment and one result per stage and size.'''
+    from sklearn.linear_model import Ridge
+    from sklearn.model_selection import train_test_split
+    from taxifare.artifacts import load_artifact, save_artifact
+    from taxifare.data import get_data
+    from taxifare.encoders import (DistanceToCenter, DistanceTransformer,
+                                   TimeFeaturesEncoder)
+    from taxifare.trainer import Trainer
+
+    results = []
+
+    def record(stage, n_rows, func, *args, **extra):
+        value, seconds, peak = measure(func, *args)
+        results.append(dict(stage=stage, n_rows=n_rows, seconds=seconds,
+                            peak_mb=peak / 1e6, **extra))
+        print(results[-1])
+        return value
+
+    tmp_dir = tempfile.mkdtemp(prefix='taxifare_bench_')
+    try:
+        for n_rows in sizes:
+            csv_path = os.path.join(tmp_dir, 'trips.csv')
+            make_trips(n_rows, seed=seed).to_csv(csv_path, index=False)
+            df = record('get_data', n_rows,
+                        lambda: get_data(nrows=None, path=csv_path))
+            df = record('clean_df', n_rows, clean_df, df)
+            for encoder in [TimeFeaturesEncoder(), DistanceTransformer(),
+                            DistanceToCenter()]:
+                record(f'{type(encoder).__name__}.transform', n_rows,
+                       encoder.transform, df)
+
+            X = df.drop(columns='fare_amount')
+            X_train, X_val, y_train, y_val = train_test_split(
+                X, df['fare_amount'], test_size=0.15, random_state=seed)
+            trainer = Trainer(X_train, y_train,
+                              model=model if model is not None else Ridge())
+            record('Trainer.run', n_rows, trainer.run)
+            record('Trainer.evaluate', n_rows, trainer.evaluate, X_val, y_val)
+
+            model_path = save_artifact(trainer.pipeline,
+                                       os.path.join(tmp_dir, 'model.joblib'))
+            record('model_load', n_rows, load_artifact, model_path,
+                   size_mb=os.path.getsize(model_path) / 1e6)
+
+            trips = X_val.head(100).assign(
+                pickup_datetime=X_val['pickup_datetime'].head(100).str[:19])
+            trips = trips.drop(columns='key').to_dict('records')
+            results.append(dict(stage='predict', n_rows=n_rows,
+                                **bench_predict(model_path, trips)))
+            print(results[-1])
+            del df, X, X_train, X_val
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return dict(environment=environment(), seed=seed, results=results)
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    '''returns the regressions of results against baseline (both run_suite
+    outputs): stages slower, heavier in memory or serving fewer requests per
+    second by more than threshold, as readable lines'''
+    def by_stage(suite):
+        return {(r['stage'], r['n_rows']): r for r in suite['results']}
+
+    regressions = []
+    previous = by_stage(baseline)
+    for key, result in by_stage(results).items():
+        if key not in previous:
+            continue
+        for metric, higher_is_better in [('seconds', False), ('peak_mb', False),
+                                         ('p50_ms', False), ('p99_ms', False),
+                                         ('requests_per_second', True)]:
+            old, new = previous[key].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f'{key[0]} @ {key[1]} rows: {metric} '
+                                   f'{old:.4g} -> {new:.4g} ({change:+.0%})')
+    return regressions
+
+
+BENCHMARKS = {'clean_df': bench_clean_df,
+              'time_features': bench_time_features,
+              'haversine': bench_haversine,
+              'serving': bench_serving,
+              'startup': bench_startup}
+
+
+if __name__ == "__main__":
+    # python -m taxifare.benchmarks <benchmark> [n_rows ...]
+    # python -m taxifare.benchmarks suite [n_rows ...]  (writes SUITE_OUTPUT)
+    # python -m taxifare.benchmarks compare <results.json> <baseline.json>
+    name = sys.argv[1] if len(sys.argv) > 1 else 'clean_df'
+    if name == 'compare':
+        with open(sys.argv[2]) as f, open(sys.argv[3]) as g:
+            regressions = compare(json.load(f), json.load(g))
+        print('\n'.join(regressions) or 'no regressions')
+        sys.exit(1 if regressions else 0)
+    if name == 'suite':
+        suite = run_suite([int(n) for n in sys.argv[2:]] or SUITE_SIZES)
+        with open(SUITE_OUTPUT, 'w') as f:
+            json.dump(suite, f, indent=1)
+        print(f'results written to {SUITE_OUTPUT}')
+        sys.exit()
+    # sizes are worker counts for the serving benchmark
+    sizes = [int(n) for n in sys.argv[2:]]
+    if name == 'time_features':
+        print(f'rows differing from pandas: {check_time_features_parity()}')
+    BENCHMARKS[name](*([sizes] if sizes else []))
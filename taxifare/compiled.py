@@ -0,0 +1,141 @@
+from datetime import datetime
+
+import numpy as np
+import pytz
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from taxifare.encoders import (NYC_CENTER, DistanceToCenter,
+                               DistanceTransformer, TimeFeaturesEncoder)
+from taxifare.utils import haversine
+
+
+def compile_encoder(encoder):
+    """Returns a function computing the encoder's features for one trip dict"""
+    if isinstance(encoder, DistanceTransformer):
+        def distance(trip):
+            return [haversine(trip[encoder.start_lat], trip[encoder.start_lon],
+                              trip[encoder.end_lat], trip[encoder.end_lon])]
+        return distance
+
+    if isinstance(encoder, DistanceToCenter):
+        def distance_to_center(trip):
+            return [haversine(*NYC_CENTER, trip['pickup_latitude'],
+                              trip['pickup_longitude']),
+                    haversine(*NYC_CENTER, trip['dropoff_latitude'],
+                              trip['dropoff_longitude'])]
+        return distance_to_center
+
+    if isinstance(encoder, TimeFeaturesEncoder):
+        time_zone = pytz.timezone(encoder.time_zone_name)
+
+        def time_features(trip):
+            utc = trip[encoder.time_column]
+            if not isinstance(utc, datetime):
+                # "2013-07-06 17:18:00 UTC"
+                utc = datetime.strptime(utc[:19], '%Y-%m-%d %H:%M:%S')\
+                    .replace(tzinfo=pytz.utc)
+            local = utc.astimezone(time_zone)
+            return [local.weekday(), local.hour, local.month, local.year]
+        return time_features
+
+    raise ValueError(f'cannot compile encoder {encoder!r}')
+
+
+def compile_postprocessor(step):
+    """Returns the output width and a function applying a fitted scaler or
+    one-hot encoder to a list of raw feature values"""
+    if isinstance(step, StandardScaler):
+        mean = step.mean_ if step.with_mean else 0.0
+        scale = step.scale_ if step.with_std else 1.0
+        return step.n_features_in_, lambda values: (np.asarray(values) - mean) / scale
+
+    if isinstance(step, OneHotEncoder):
+        if step.handle_unknown != 'ignore' or step.drop is not None:
+            raise ValueError(f'cannot compile {step!r}')
+        offsets = np.cumsum([0] + [len(c) for c in step.categories_])
+        positions = [{category: offset + i for i, category in enumerate(categories)}
+                     for offset, categories in zip(offsets, step.categories_)]
+
+        def one_hot(values):
+            out = np.zeros(offsets[-1])
+            for value, position in zip(values, positions):
+                if value in position:
+                    out[position[value]] = 1.0
+            return out
+        return offsets[-1], one_hot
+
+    raise ValueError(f'cannot compile {step!r}')
+
+
+class CompiledPipeline():
+    """Pandas-free scorer for a fitted Trainer pipeline.
+
+    Reads the fitted scaler statistics, one-hot categories and final
+    estimator out of the pipeline and computes the same feature vector
+    for a single trip with scalar math, which avoids the per-call DataFrame
+    and ColumnTransformer overhead when scoring one row.
+    A ValueError is raised for pipelines it cannot reproduce.
+    """
+
+    def __init__(self, pipeline):
+        if not isinstance(pipeline, Pipeline) or len(pipeline.steps) != 2 or \
+                not isinstance(pipeline.steps[0][1], ColumnTransformer):
+            raise ValueError('expected a ColumnTransformer + estimator pipeline')
+        preproc, self.estimator = pipeline.steps[0][1], pipeline.steps[1][1]
+        self.blocks = []
+        for name, block, columns in preproc.transformers_:
+            if isinstance(block, str) and block == 'drop':
+                continue
+            if not isinstance(block, Pipeline) or len(block.steps) != 2:
+                raise ValueError(f'cannot compile block {name}')
+            encoder = compile_encoder(block.steps[0][1])
+            width, postprocessor = compile_postprocessor(block.steps[1][1])
+            self.blocks.append((encoder, postprocessor, width))
+        self.n_features = sum(width for _, _, width in self.blocks)
+
+    def features(self, trip):
+        """Returns the feature vector of one trip dict, with the same keys as
+        the DataFrame columns the pipeline was trained on"""
+        x = np.empty(self.n_features)
+        start = 0
+        for encoder, postprocessor, width in self.blocks:
+            x[start:start + width] = postprocessor(encoder(trip))
+            start += width
+        return x
+
+    def predict_one(self, trip):
+        return float(self.estimator.predict(self.features(trip)[None, :])[0])
+
+    def predict(self, trips):
+        """Scores a list of trip dicts"""
+        X = np.vstack([self.features(trip) for trip in trips])
+        return self.estimator.predict(X)
+
+
+def compile_pipeline(pipeline):
+    """Returns a CompiledPipeline, or None if the pipeline is not supported"""
+    try:
+        return CompiledPipeline(pipeline)
+    except (ValueError, AttributeError):
+        return None
+
+
+def check_parity(pipeline, X, compiled=None):
+    """Returns the max absolute difference between pipeline.predict(X) and
+    the compiled scorer on each row of the DataFrame X"""
+    compiled = compiled or CompiledPipeline(pipeline)
+    expected = pipeline.predict(X)
+    trips = X.to_dict('records')
+    actual = np.array([compiled.predict_one(trip) for trip in trips])
+    return float(np.abs(actual - expected).max())
+
+
+if __name__ == "__main__":
+    import joblib
+    from taxifare.data import get_data, clean_df
+
+    pipeline = joblib.load('joblib/model.joblib')
+    df = clean_df(get_data(nrows=1000)).drop('fare_amount', axis=1)
+    print(f'max abs difference: {check_parity(pipeline, df)}')
@@ -1,27 +1,408 @@
+import hashlib
+import inspect
+import io
+import json
+import mmap
 import os
+import shutil
+import tempfile
+import threading
+from collections import Counter, namedtuple
 
+import numpy as np
 import pandas as pd
 
+from taxifare.instrumentation import timed, timed_function
+from taxifare.utils import local_time_features, parse_utc_seconds
+
 LOCAL_PATH = os.path.join(os.path.dirname(__file__), '..', 'raw_data', 'train.csv')
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'raw_data', 'cache')
 
-def get_data(nrows=10_000, **kwargs):
-    '''returns a DataFrame with nrows'''
-    df = pd.read_csv(LOCAL_PATH, nrows=nrows)
-    return df
+# compact dtypes for chunked reads, passenger_count is read as float32 to
+# allow missing values and cast to uint8 once the chunk is cleaned
+CSV_DTYPES = {'key': str,
+              'fare_amount': 'float32',
+              'pickup_datetime': str,
+              'pickup_longitude': 'float32',
+              'pickup_latitude': 'float32',
+              'dropoff_longitude': 'float32',
+              'dropoff_latitude': 'float32',
+              'passenger_count': 'float32'}
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
 
 
-def clean_df(df):
-    df = df.dropna(how='any', axis='rows')
-    df = df[(df.dropoff_latitude != 0) | (df.dropoff_longitude != 0)]
-    df = df[(df.pickup_latitude != 0) | (df.pickup_longitude != 0)]
-    df = df[(df['pickup_latitude'] != df['dropoff_latitude']) & \
-            (df['pickup_longitude'] != df['dropoff_longitude'])]
-    if "fare_amount" in list(df):
-        df = df[df['fare_amount'].between(0, 4000, inclusive='right')]
-    df = df[df.passenger_count <= 8]
-    df = df[df.passenger_count > 0]
-    df = df[df["pickup_latitude"].between(left=40, right=42)]
-    df = df[df["pickup_longitude"].between(left=-74.3, right=-72.9)]
-    df = df[df["dropoff_latitude"].between(left=40, right=42)]
-    df = df[df["dropoff_longitude"].between(left=-74, right=-72.9)]
+def get_data(nrows=10_000, chunksize=None, cache=False, **kwargs):
+    '''returns a DataFrame with nrows, or a generator of cleaned chunks of
+    chunksize rows when chunksize is given (see iter_data).
+    With cache=True the cleaned rows are read from the columnar cache, which
+    is built on first use (see read_cache for the columns and rows kwargs).
+    The path kwarg reads another file than LOCAL_PATH.
+    With sample='reservoir', 'stratified' or 'index' (and an optional seed)
+    nrows rows are sampled from the whole file instead of read from its
+    head, see sample_data and sample_rows.'''
+    path = kwargs.get('path', LOCAL_PATH)
+    sample = kwargs.get('sample')
+    if sample == 'index':
+        return sample_rows(nrows, seed=kwargs.get('seed', 0), path=path)
+    if sample:
+        return sample_data(nrows, method=sample, seed=kwargs.get('seed', 0),
+                           path=path)
+    if cache:
+        return read_cache(nrows=nrows, columns=kwargs.get('columns'),
+                          rows=kwargs.get('rows'), path=path)
+    if chunksize:
+        return iter_data(nrows=nrows, chunksize=chunksize, path=path,
+                         stats=kwargs.get('stats'))
+    with timed('data.read_csv') as timer:
+        df = pd.read_csv(path, nrows=nrows)
+        timer.rows = len(df)
     return df
+
+
+def iter_data(nrows=None, chunksize=1_000_000, path=LOCAL_PATH, stats=None):
+    '''yields cleaned DataFrames of at most chunksize rows, with float32
+    coordinates and fare, uint8 passenger_count and pickup_datetime parsed
+    to UTC datetimes. Pass a Counter as stats to collect the rows read and
+    the rows rejected by each cleaning rule.'''
+    reader = pd.read_csv(path, nrows=nrows, chunksize=chunksize,
+                         dtype=CSV_DTYPES)
+    for chunk in reader:
+        with timed('data.parse_datetime', len(chunk)):
+            chunk['pickup_datetime'] = pd.to_datetime(chunk['pickup_datetime'],
+                                                      format=DATETIME_FORMAT,
+                                                      utc=True, errors='coerce')
+        chunk = clean_df(chunk, stats=stats)
+        chunk['passenger_count'] = chunk['passenger_count'].astype('uint8')
+        yield chunk
+
+
+def time_strata(pickup_datetime, time_zone_name='America/New_York'):
+    '''stratum of each row for stratified sampling: its local year, month
+    and hour as one integer, -1 when the datetime cannot be parsed'''
+    seconds = parse_utc_seconds(pickup_datetime)
+    valid = None
+    if seconds is None:
+        parsed = pd.to_datetime(pd.Series(pickup_datetime), format=DATETIME_FORMAT,
+                                utc=True, errors='coerce')
+        valid = parsed.notna().to_numpy()
+        seconds = parsed.dt.tz_localize(None).to_numpy(dtype='datetime64[s]')\
+            .astype('int64')
+        seconds[~valid] = 0
+    _, hour, month, year = local_time_features(seconds, time_zone_name).T
+    strata = (year * 12 + month - 1) * 24 + hour
+    if valid is not None:
+        strata[~valid] = -1
+    return strata
+
+
+def sample_data(n, method='reservoir', seed=0, path=LOCAL_PATH,
+                chunksize=1_000_000):
+    '''returns n raw rows of path sampled in one streaming pass, in file
+    order. Every row gets a seeded uniform random key and the rows with the
+    n smallest keys are kept (bottom-k sampling, equivalent to a reservoir
+    sample without replacement), so memory is bounded by n plus a chunk and
+    the sample does not depend on chunksize.
+    method='stratified' allocates the n rows to the local year x month x
+    hour strata in proportion to their exact sizes: the 2n smallest keys
+    are kept and each stratum contributes its smallest ones.
+    Rows are sampled before cleaning, pass the result to clean_df.'''
+    if method not in ('reservoir', 'stratified'):
+        raise ValueError("method should be 'reservoir' or 'stratified'")
+    rng = np.random.default_rng(seed)
+    keep = n if method == 'reservoir' else 2 * n
+    kept, counts, start = None, Counter(), 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=CSV_DTYPES):
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        chunk['_key'] = rng.random(len(chunk))
+        if method == 'stratified':
+            chunk['_stratum'] = time_strata(chunk['pickup_datetime'])
+            counts.update(dict(zip(*np.unique(chunk['_stratum'],
+                                              return_counts=True))))
+        chunk = chunk.nsmallest(keep, '_key')
+        kept = chunk if kept is None else \
+            pd.concat([kept, chunk]).nsmallest(keep, '_key')
+    if kept is None:
+        return pd.DataFrame(columns=list(CSV_DTYPES))
+
+    if method == 'stratified' and start > n:
+        # largest remainder allocation of the n rows to the strata
+        strata = np.array(sorted(counts))
+        sizes = np.array([counts[stratum] for stratum in strata])
+        quotas = n * sizes / sizes.sum()
+        allocation = np.floor(quotas).astype('int64')
+        shortfall = n - allocation.sum()
+        allocation[np.argsort(allocation - quotas)[:shortfall]] += 1
+        rank = kept.groupby('_stratum')['_key'].rank(method='first')
+        quota = kept['_stratum'].map(dict(zip(strata, allocation)))
+        selected = rank <= quota
+        # a small stratum can have fewer kept rows than its quota, the
+        # remaining rows with the smallest keys make up for it
+        extra = kept[~selected].nsmallest(n - selected.sum(), '_key')
+        kept = pd.concat([kept[selected], extra])
+    return kept.drop(columns=['_key', '_stratum'], errors='ignore')\
+        .sort_index().reset_index(drop=True)
+
+
+def row_index_path(path=LOCAL_PATH, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'{file_hash(path)}.rows.npy')
+
+
+def build_row_index(path=LOCAL_PATH, cache_dir=CACHE_DIR, block_size=1 << 26):
+    '''saves the byte offset of the start of every line of path (the
+    header first, plus the file size at the end) and returns the index path.
+    Built in one pass over the bytes, named after the file hash so it is
+    rebuilt when the file changes.'''
+    index_path = row_index_path(path, cache_dir)
+    if os.path.isfile(index_path):
+        return index_path
+    os.makedirs(cache_dir, exist_ok=True)
+    offsets, position = [np.zeros(1, dtype='int64')], 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            newlines = np.flatnonzero(np.frombuffer(block, dtype='uint8') == 10)
+            offsets.append(newlines.astype('int64') + position + 1)
+            position += len(block)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        # no newline at the end of the last line
+        offsets = np.append(offsets, position)
+    tmp = f'{index_path}.tmp.npy'
+    np.save(tmp, offsets)
+    os.replace(tmp, index_path)
+    return index_path
+
+
+def sample_rows(n, seed=0, path=LOCAL_PATH, cache_dir=CACHE_DIR):
+    '''returns n raw rows of path drawn uniformly without replacement, in
+    file order, reading only those rows through the row offset index (built
+    on first use)'''
+    offsets = np.load(build_row_index(path, cache_dir), mmap_mode='r')
+    n_rows = len(offsets) - 2
+    rows = np.sort(np.random.default_rng(seed).choice(n_rows, min(n, n_rows),
+                                                      replace=False)) + 1
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        lines = [data[offsets[0]:offsets[1]]]
+        lines += [data[offsets[row]:offsets[row + 1]] for row in rows]
+    return pd.read_csv(io.BytesIO(b''.join(lines)), dtype=CSV_DTYPES)
+
+
+def holdout_mask(keys, fraction=0.15):
+    '''deterministic boolean mask of the rows assigned to the holdout set,
+    from a hash of their key, so the split is the same on every run and does
+    not need the whole dataset in memory'''
+    hashes = pd.util.hash_pandas_object(pd.Series(keys), index=False).to_numpy()
+    return hashes % 10_000 < fraction * 10_000
+
+
+def split_chunks(chunks, holdout=False, fraction=0.15):
+    '''yields the train part (or the holdout part when holdout=True) of each
+    chunk of a stream, split with holdout_mask'''
+    for chunk in chunks:
+        mask = holdout_mask(chunk['key'], fraction)
+        yield chunk[mask if holdout else ~mask]
+
+
+# bounds checks applied by clean_df: (name, column, low, high, inclusive)
+# where inclusive is 'both', 'left', 'right' or 'neither' as in Series.between
+Rule = namedtuple('Rule', ['name', 'column', 'low', 'high', 'inclusive'])
+CLEANING_RULES = [
+    Rule('fare_amount', 'fare_amount', 0, 4000, 'right'),
+    Rule('passenger_count', 'passenger_count', 0, 8, 'right'),
+    Rule('pickup_latitude', 'pickup_latitude', 40, 42, 'both'),
+    Rule('pickup_longitude', 'pickup_longitude', -74.3, -72.9, 'both'),
+    Rule('dropoff_latitude', 'dropoff_latitude', 40, 42, 'both'),
+    Rule('dropoff_longitude', 'dropoff_longitude', -74, -72.9, 'both'),
+]
+
+
+def rule_mask(values, rule):
+    '''boolean mask of the values passing a bounds rule, NaN fails'''
+    low = values >= rule.low if rule.inclusive in ('both', 'left') \
+        else values > rule.low
+    high = values <= rule.high if rule.inclusive in ('both', 'right') \
+        else values < rule.high
+    return low & high
+
+
+def row_checks(df):
+    '''yields (name, mask) for the checks that are not simple bounds'''
+    yield 'missing_values', df.notna().to_numpy().all(axis=1)
+    for point in ('pickup', 'dropoff'):
+        lat = df[f'{point}_latitude'].to_numpy()
+        lon = df[f'{point}_longitude'].to_numpy()
+        yield f'{point}_zero', (lat != 0) | (lon != 0)
+    yield 'same_location', \
+        (df['pickup_latitude'].to_numpy() != df['dropoff_latitude'].to_numpy()) & \
+        (df['pickup_longitude'].to_numpy() != df['dropoff_longitude'].to_numpy())
+
+
+@timed_function('data.clean_df')
+def clean_df(df, stats=None, rules=CLEANING_RULES):
+    '''removes invalid rows with one combined mask and a single copy.
+    When stats is a Counter it is updated with rows_read, rows_kept and, for
+    each rule, the number of rows it rejects (a row failing several rules
+    is counted once per rule).'''
+    keep = np.ones(len(df), dtype=bool)
+    masks = list(row_checks(df))
+    for rule in rules:
+        if rule.column in df:
+            masks.append((rule.name, rule_mask(df[rule.column].to_numpy(), rule)))
+    for name, mask in masks:
+        keep &= mask
+        if stats is not None:
+            stats[name] += int(len(mask) - np.count_nonzero(mask))
+    if stats is not None:
+        stats['rows_read'] += len(df)
+        stats['rows_kept'] += int(np.count_nonzero(keep))
+    return df[keep]
+
+
+def file_hash(path):
+    '''returns the sha1 of a file, memoized in a `<path>.sha1` sidecar file
+    which is trusted as long as the file size and mtime are unchanged'''
+    stat = os.stat(path)
+    stamp = f'{stat.st_size}:{stat.st_mtime_ns}'
+    sidecar = f'{path}.sha1'
+    if os.path.isfile(sidecar):
+        with open(sidecar) as f:
+            saved_stamp, digest = f.read().split()
+        if saved_stamp == stamp:
+            return digest
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(block)
+    tmp = f'{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(f'{stamp} {sha1.hexdigest()}')
+    os.replace(tmp, sidecar)
+    return sha1.hexdigest()
+
+
+def cache_key(path=LOCAL_PATH, nrows=None):
+    '''hash of the source file, the cleaning definition and nrows'''
+    cleaning = inspect.getsource(row_checks) + inspect.getsource(rule_mask) + \
+        repr(CLEANING_RULES) + repr(CSV_DTYPES) + DATETIME_FORMAT
+    key = f'{file_hash(path)}:{hashlib.sha1(cleaning.encode()).hexdigest()}:{nrows}'
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def build_cache(path=LOCAL_PATH, nrows=None, cache_dir=CACHE_DIR,
+                chunksize=1_000_000):
+    '''streams the cleaned data into one raw file per column and returns the
+    cache directory. Strings are stored newline separated with an offsets
+    file, pickup_datetime as int64 UTC nanoseconds. Caches built for older
+    versions of the same source file are removed. The cache is written to
+    a temporary directory and renamed, so concurrent builds are safe.'''
+    key = cache_key(path, nrows)
+    target = os.path.join(cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    # a directory of its own, concurrent builders don't write over each other
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=f'{key}.', suffix='.tmp')
+
+    stats = Counter()
+    dtypes, files, offsets, n_rows = {}, {}, {}, 0
+    for chunk in iter_data(nrows=nrows, chunksize=chunksize, path=path,
+                           stats=stats):
+        for column in chunk.columns:
+            if column not in files:
+                files[column] = open(os.path.join(tmp, f'{column}.bin'), 'wb')
+            values = chunk[column]
+            if values.dtype == object:
+                encoded = [f'{value}\n'.encode() for value in values]
+                lengths = np.fromiter(map(len, encoded), dtype='int64',
+                                      count=len(encoded))
+                ends = offsets.setdefault(column, [np.zeros(1, dtype='int64')])
+                ends.append(ends[-1][-1] + np.cumsum(lengths))
+                files[column].write(b''.join(encoded))
+                dtypes[column] = 'str'
+            else:
+                array = values.to_numpy()
+                if isinstance(values.dtype, pd.DatetimeTZDtype):
+                    array = values.dt.tz_convert(None).to_numpy()
+                files[column].write(np.ascontiguousarray(array).tobytes())
+                dtypes[column] = str(array.dtype)
+        n_rows += len(chunk)
+    for f in files.values():
+        f.close()
+    for column, ends in offsets.items():
+        np.save(os.path.join(tmp, f'{column}.offsets.npy'), np.concatenate(ends))
+
+    meta = dict(source=os.path.abspath(path), nrows=nrows, n_rows=n_rows,
+                dtypes=dtypes, stats=dict(stats))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if not os.path.isfile(os.path.join(target, 'meta.json')):
+        shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        # another builder published the same cache first, keep that one
+        shutil.rmtree(tmp, ignore_errors=True)
+    for other in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, other, 'meta.json')
+        # the .tmp directories are builds in progress
+        if other != key and not other.endswith('.tmp') and \
+                os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                other_meta = json.load(f)
+            if other_meta['source'] == meta['source'] and \
+                    other_meta['nrows'] == nrows:
+                shutil.rmtree(os.path.join(cache_dir, other))
+    return target
+
+
+def read_columns(cache_path, columns=None, rows=None):
+    '''returns a dict of memory-mapped column arrays from a cache directory.
+    columns restricts which column files are opened, rows is a
+    (start, stop) tuple or slice; string columns are decoded to lists.'''
+    with open(os.path.join(cache_path, 'meta.json')) as f:
+        meta = json.load(f)
+    if isinstance(rows, tuple):
+        rows = slice(*rows)
+    start, stop, _ = (rows or slice(None)).indices(meta['n_rows'])
+    arrays = {}
+    for column in columns or meta['dtypes']:
+        dtype = meta['dtypes'][column]
+        file_path = os.path.join(cache_path, f'{column}.bin')
+        if dtype == 'str':
+            offsets = np.load(os.path.join(cache_path, f'{column}.offsets.npy'),
+                              mmap_mode='r')
+            data = np.memmap(file_path, dtype='uint8', mode='r') \
+                if offsets[-1] else np.zeros(0, dtype='uint8')
+            text = data[offsets[start]:offsets[stop]].tobytes().decode()
+            arrays[column] = text.split('\n')[:-1]
+        elif stop > start:
+            itemsize = np.dtype(dtype).itemsize
+            arrays[column] = np.memmap(file_path, dtype=dtype, mode='r',
+                                       offset=start * itemsize,
+                                       shape=(stop - start,))
+        else:
+            arrays[column] = np.zeros(0, dtype=dtype)
+    return arrays
+
+
+@timed_function('data.read_cache')
+def read_cache(nrows=None, columns=None, rows=None, path=LOCAL_PATH,
+               cache_dir=CACHE_DIR):
+    '''returns the cleaned data of the first nrows of path as a DataFrame,
+    reading only the requested columns and rows from the columnar cache and
+    building the cache first if the source or the cleaning changed'''
+    cache_path = os.path.join(cache_dir, cache_key(path, nrows))
+    if not os.path.isfile(os.path.join(cache_path, 'meta.json')):
+        build_cache(path, nrows, cache_dir)
+    arrays = read_columns(cache_path, columns, rows)
+    if 'pickup_datetime' in arrays:
+        arrays['pickup_datetime'] = pd.DatetimeIndex(
+            arrays['pickup_datetime']).tz_localize('UTC')
+    return pd.DataFrame(arrays)
+
+
+if __name__ == "__main__":
+    stats = Counter()
+    for chunk in get_data(nrows=None, chunksize=100_000, stats=stats):
+        print(f'chunk: {len(chunk)} rows, {chunk.memory_usage(deep=True).sum()} bytes')
+    print(dict(stats))
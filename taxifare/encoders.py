@@ -1,11 +1,15 @@
+import numpy as np
 import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
-from taxifare.data import get_data, clean_df
-from taxifare.utils import haversine_vectorized
+from taxifare.utils import (distance_features, local_time_features,
+                            parse_utc_seconds)
+
+NYC_CENTER = (40.7141667, -74.0063889)
 
 class TimeFeaturesEncoder(BaseEstimator, TransformerMixin):
     """Extract the day of week (dow), the hour, the month and the year from a time column.
-    Returns a copy of the DataFrame X with only four columns: 'dow', 'hour', 'month', 'year'.
+    Returns a new DataFrame with only four columns: 'dow', 'hour', 'month', 'year'.
+    X is left untouched.
     """
 
     def __init__(self, time_column='pickup_datetime', time_zone_name='America/New_York'):
@@ -17,18 +21,29 @@ class TimeFeaturesEncoder(BaseEstimator, TransformerMixin):
 
     def transform(self, X, y=None):
         assert isinstance(X, pd.DataFrame)
-        X.index = pd.to_datetime(X[self.time_column])
-        X.index = X.index.tz_convert(self.time_zone_name)
-        X["dow"] = X.index.weekday
-        X["hour"] = X.index.hour
-        X["month"] = X.index.month
-        X["year"] = X.index.year
-        return X[['dow', 'hour', 'month', 'year']]
+        out = np.empty((len(X), 4), dtype='int64')
+        seconds = parse_utc_seconds(X[self.time_column])
+        if seconds is not None:
+            local_time_features(seconds, self.time_zone_name, out=out)
+        else:
+            # not in the "%Y-%m-%d %H:%M:%S UTC" format, let pandas parse it
+            local = pd.DatetimeIndex(pd.to_datetime(X[self.time_column]))\
+                .tz_convert(self.time_zone_name)
+            if local.hasnans:
+                # missing datetimes give NaN features, as pandas does
+                out = out.astype('float64')
+            out[:, 0] = local.weekday
+            out[:, 1] = local.hour
+            out[:, 2] = local.month
+            out[:, 3] = local.year
+        return pd.DataFrame(out, columns=['dow', 'hour', 'month', 'year'],
+                            index=X.index)
 
 
 class DistanceTransformer(BaseEstimator, TransformerMixin):
     """Compute the haversine distance between two GPS points.
-    Returns a copy of the DataFrame X with only one column: 'distance', units km.
+    Returns a new DataFrame with only one column: 'distance', units km.
+    X is left untouched.
     """
     def __init__(self,
                  start_lat="pickup_latitude",
@@ -45,18 +60,21 @@ class DistanceTransformer(BaseEstimator, TransformerMixin):
 
     def transform(self, X, y=None):
         assert isinstance(X, pd.DataFrame)
-        X["distance"] = haversine_vectorized(
-            X,
-            start_lat=self.start_lat,
-            start_lon=self.start_lon,
-            end_lat=self.end_lat,
-            end_lon=self.end_lon
+        out = distance_features(
+            X[self.start_lat].to_numpy(),
+            X[self.start_lon].to_numpy(),
+            X[self.end_lat].to_numpy(),
+            X[self.end_lon].to_numpy(),
+            NYC_CENTER, columns=['distance']
         )
-        return X[['distance']]
+        return pd.DataFrame(out, columns=['distance'], index=X.index)
 
 
 class DistanceToCenter(BaseEstimator, TransformerMixin):
-    """Compute the haversine distance to the NYC center for both pickup and dropoff locations."""
+    """Compute the haversine distance to the NYC center for both pickup and dropoff locations.
+    Returns a new DataFrame with two columns: 'pickup_distance_to_center' and
+    'dropoff_distance_to_center', units km. X is left untouched.
+    """
     def __init__(self):
         pass
 
@@ -65,18 +83,22 @@ class DistanceToCenter(BaseEstimator, TransformerMixin):
 
     def transform(self, X, y=None):
         assert isinstance(X, pd.DataFrame)
-        nyc_center = (40.7141667, -74.0063889)
-        X["nyc_lat"], X["nyc_lng"] = nyc_center[0], nyc_center[1]
-        kwargs_pickup = dict(start_lat="nyc_lat", start_lon="nyc_lng",
-                           end_lat="pickup_latitude", end_lon="pickup_longitude")
-        kwargs_dropoff = dict(start_lat="nyc_lat", start_lon="nyc_lng",
-                            end_lat="dropoff_latitude", end_lon="dropoff_longitude")
-        X['pickup_distance_to_center'] = haversine_vectorized(X, **kwargs_pickup)
-        X['dropoff_distance_to_center'] = haversine_vectorized(X, **kwargs_dropoff)
-        return X[["pickup_distance_to_center", "dropoff_distance_to_center"]]
+        out = distance_features(
+            X['pickup_latitude'].to_numpy(),
+            X['pickup_longitude'].to_numpy(),
+            X['dropoff_latitude'].to_numpy(),
+            X['dropoff_longitude'].to_numpy(),
+            NYC_CENTER, columns=['pickup_distance_to_center',
+                                 'dropoff_distance_to_center']
+        )
+        return pd.DataFrame(out, index=X.index,
+                            columns=["pickup_distance_to_center",
+                                     "dropoff_distance_to_center"])
 
 
 if __name__ == "__main__":
+    from taxifare.data import get_data, clean_df
+
     df = get_data()
     df = clean_df(df)
 
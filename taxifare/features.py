@@ -0,0 +1,237 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+import joblib
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from taxifare import utils
+from taxifare.data import CACHE_DIR, LOCAL_PATH, build_cache, cache_key, read_cache
+from taxifare.encoders import DistanceToCenter, DistanceTransformer, TimeFeaturesEncoder
+from taxifare.sweep import FEATURE_BLOCKS, compute_features, feature_columns
+
+FEATURE_DIR = os.path.join(os.path.dirname(__file__), '..', 'raw_data', 'features')
+TARGET = 'fare_amount'
+# encoder, input columns and stored dtype of each block of FEATURE_BLOCKS
+BLOCK_ENCODERS = {'dist': DistanceTransformer,
+                  'dist_to_center': DistanceToCenter,
+                  'time': TimeFeaturesEncoder}
+BLOCK_COLUMNS = {'dist': ['pickup_latitude', 'pickup_longitude',
+                          'dropoff_latitude', 'dropoff_longitude'],
+                 'dist_to_center': ['pickup_latitude', 'pickup_longitude',
+                                    'dropoff_latitude', 'dropoff_longitude'],
+                 'time': ['pickup_datetime']}
+BLOCK_DTYPES = {'dist': 'float64', 'dist_to_center': 'float64', 'time': 'int16'}
+# the taxifare.utils kernels each encoder computes its features with
+DISTANCE_KERNELS = [utils.EARTH_RADIUS, utils.distance_features,
+                    utils.haversine_kernel]
+BLOCK_KERNELS = {'dist': DISTANCE_KERNELS,
+                 'dist_to_center': DISTANCE_KERNELS,
+                 'time': [utils.UTC_FORMAT_LENGTH, utils.UTC_FORMAT_DIGITS,
+                          utils.UTC_FORMAT_SEPARATORS, utils.DAYS_IN_MONTH,
+                          utils.days_from_civil, utils.civil_from_days,
+                          utils.parse_utc_seconds, utils.utc_offset_table,
+                          utils.local_time_features]}
+
+
+def kernel_source(kernel):
+    if callable(kernel):
+        # unwraps lru_cache and other decorators
+        return inspect.getsource(inspect.unwrap(kernel))
+    return repr(kernel.tolist() if isinstance(kernel, np.ndarray) else kernel)
+
+
+def block_key(block):
+    '''hash of what a block's values depend on besides the data: the encoder
+    parameters, its code and the kernels it uses, so unrelated edits of
+    taxifare.utils do not make the stored blocks stale'''
+    encoder = BLOCK_ENCODERS[block]()
+    definition = repr(sorted(encoder.get_params().items())) + \
+        inspect.getsource(type(encoder)) + \
+        ''.join(kernel_source(kernel) for kernel in BLOCK_KERNELS[block]) + \
+        BLOCK_DTYPES[block]
+    return hashlib.sha1(definition.encode()).hexdigest()[:16]
+
+
+def _encode_rows(source, cache_dir, block, out_path, start, stop):
+    '''computes one block for a range of cleaned rows of source and writes it
+    into the preallocated .npy file, run in a worker process'''
+    df = read_cache(columns=BLOCK_COLUMNS[block], rows=(start, stop),
+                    path=source, cache_dir=cache_dir)
+    out = np.load(out_path, mmap_mode='r+')
+    out[start:stop] = BLOCK_ENCODERS[block]().transform(df).to_numpy()
+    out.flush()
+
+
+class FeatureMatrixEncoder(BaseEstimator, TransformerMixin):
+    """Computes all the feature blocks of a raw DataFrame as one array with
+    the columns of taxifare.sweep.feature_columns, i.e. what a FeatureStore
+    holds. Used in front of models trained from the store so they can be
+    used on raw trips.
+    """
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        return compute_features(X)
+
+
+class FeatureStore():
+    """Engineered features of whole data files, computed once and stored as
+    one .npy matrix per feature block, memory-mapped when read.
+
+    The store is made of segments, one per source CSV file (the history,
+    then e.g. one file per month). Each stored block records the cleaned
+    data cache key of its source (file contents and cleaning code) and the
+    block_key of its encoder, and is stale when either changes. build()
+    only recomputes stale blocks, so appending a month leaves the history
+    untouched. Blocks are computed in parallel over row ranges.
+
+        store = FeatureStore()
+        store.append('raw_data/train.csv')
+        store.append('raw_data/2015-07.csv')
+        X, y = store.load()
+    """
+
+    def __init__(self, directory=FEATURE_DIR, cache_dir=CACHE_DIR, n_jobs=None,
+                 rows_per_job=1_000_000):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.n_jobs = n_jobs
+        self.rows_per_job = rows_per_job
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def read_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return {'segments': []}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        tmp = f'{self.manifest_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def add_source(self, path=LOCAL_PATH, name=None):
+        '''registers a source file as the last segment, if not already there'''
+        manifest = self.read_manifest()
+        source = os.path.abspath(path)
+        if any(segment['source'] == source for segment in manifest['segments']):
+            return
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        if any(segment['name'] == name for segment in manifest['segments']):
+            raise ValueError(f'a segment named {name} already exists')
+        manifest['segments'].append(dict(name=name, source=source, blocks={}))
+        self.write_manifest(manifest)
+
+    def stale(self):
+        '''returns the (segment name, block) pairs to (re)compute'''
+        pairs = []
+        for segment in self.read_manifest()['segments']:
+            data_key = cache_key(segment['source'])
+            for block in list(FEATURE_BLOCKS) + [TARGET]:
+                stored = segment['blocks'].get(block)
+                key = block_key(block) if block != TARGET else None
+                if stored is None or stored['data_key'] != data_key or \
+                        stored['key'] != key:
+                    pairs.append((segment['name'], block))
+        return pairs
+
+    def build(self):
+        '''computes the stale blocks and returns the pairs that were built'''
+        pairs = self.stale()
+        for name, block in pairs:
+            manifest = self.read_manifest()
+            segment = next(s for s in manifest['segments'] if s['name'] == name)
+            self._build_block(segment, block)
+            self.write_manifest(manifest)
+        return pairs
+
+    def _build_block(self, segment, block):
+        source = segment['source']
+        data_key = cache_key(source)
+        cache_path = os.path.join(self.cache_dir, data_key)
+        if not os.path.isfile(os.path.join(cache_path, 'meta.json')):
+            build_cache(source, cache_dir=self.cache_dir)
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            n_rows = json.load(f)['n_rows']
+
+        segment_dir = os.path.join(self.directory, segment['name'])
+        os.makedirs(segment_dir, exist_ok=True)
+        path = os.path.join(segment_dir, f'{block}.npy')
+        tmp = f'{path}.tmp.npy'
+        if block == TARGET:
+            target = read_cache(columns=[TARGET], path=source,
+                                cache_dir=self.cache_dir)[TARGET].to_numpy()
+            np.save(tmp, target)
+            key = None
+        else:
+            shape = (n_rows, len(FEATURE_BLOCKS[block]))
+            np.lib.format.open_memmap(tmp, mode='w+', dtype=BLOCK_DTYPES[block],
+                                      shape=shape).flush()
+            joblib.Parallel(n_jobs=self.n_jobs)(
+                joblib.delayed(_encode_rows)(source, self.cache_dir, block, tmp,
+                                             start, min(start + self.rows_per_job,
+                                                        n_rows))
+                for start in range(0, n_rows, self.rows_per_job))
+            key = block_key(block)
+        os.replace(tmp, path)
+        segment['blocks'][block] = dict(key=key, data_key=data_key,
+                                        n_rows=n_rows)
+
+    def append(self, path, name=None):
+        '''adds a new source file (e.g. a month of data) and builds what is
+        stale, which is only the new segment unless something else changed'''
+        self.add_source(path, name)
+        return self.build()
+
+    def remove(self, name):
+        manifest = self.read_manifest()
+        manifest['segments'] = [segment for segment in manifest['segments']
+                                if segment['name'] != name]
+        self.write_manifest(manifest)
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def read_block(self, block, segments=None):
+        '''returns the memory-mapped arrays of one block, one per segment'''
+        if self.stale():
+            raise ValueError('the feature store is stale, call build() first')
+        names = segments or [segment['name']
+                             for segment in self.read_manifest()['segments']]
+        return [np.load(os.path.join(self.directory, name, f'{block}.npy'),
+                        mmap_mode='r') for name in names]
+
+    def load(self, segments=None):
+        '''returns the features of all (or the given) segments as one float64
+        array with the columns of feature_columns(), and the target'''
+        blocks = [self.read_block(block, segments) for block in FEATURE_BLOCKS]
+        y = np.concatenate(self.read_block(TARGET, segments))
+        # filled from the memory-mapped blocks, one segment at a time, so
+        # only X is held in memory
+        X = np.empty((len(y), len(feature_columns())))
+        column = 0
+        for segments_values in blocks:
+            width = segments_values[0].shape[1]
+            row = 0
+            for values in segments_values:
+                X[row:row + len(values), column:column + width] = values
+                row += len(values)
+            column += width
+        return X, y
+
+
+if __name__ == "__main__":
+    store = FeatureStore()
+    store.add_source(LOCAL_PATH)
+    print(f'built: {store.build()}')
+    X, y = store.load()
+    print(X.shape, y.shape)
@@ -0,0 +1,233 @@
+import copy
+import functools
+import os
+import threading
+import time
+
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+
+# opt-in: when disabled, timers are a shared no-op object and no wrapper
+# is inserted in the pipelines
+ENABLED = os.environ.get('TAXIFARE_INSTRUMENT', '') == '1'
+# latency histogram buckets in seconds, 0.1 ms to about 100 s
+BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def enabled():
+    return ENABLED
+
+
+class StageMetrics():
+    """Latency histogram and row count of one stage"""
+
+    def __init__(self):
+        self.buckets = np.zeros(len(BUCKETS) + 1, dtype='int64')
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+    def observe(self, seconds, rows=None):
+        self.buckets[np.searchsorted(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.rows += rows or 0
+
+    def quantile(self, q):
+        '''upper bound of the bucket holding the q quantile'''
+        if not self.count:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.buckets), q * self.count))
+        return BUCKETS[index] if index < len(BUCKETS) else float('inf')
+
+
+_metrics = {}
+_lock = threading.Lock()
+
+
+def observe(stage, seconds, rows=None):
+    with _lock:
+        if stage not in _metrics:
+            _metrics[stage] = StageMetrics()
+        _metrics[stage].observe(seconds, rows)
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+class _Timer():
+    __slots__ = ('stage', 'rows', 'start')
+
+    def __init__(self, stage, rows):
+        self.stage = stage
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start, self.rows)
+
+
+class _NullTimer():
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def timed(stage, rows=None):
+    """Context manager recording the duration of its block under stage.
+    The row count can be given or set on the timer inside the block."""
+    if not ENABLED:
+        return NULL_TIMER
+    return _Timer(stage, rows)
+
+
+def timed_function(stage):
+    """Decorator recording each call of the function, with the length of
+    its result as row count"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            rows = len(result) if hasattr(result, '__len__') else None
+            observe(stage, time.perf_counter() - start, rows)
+            return result
+        return wrapper
+    return decorator
+
+
+class Timed(BaseEstimator):
+    """Wraps a transformer or estimator of a pipeline and records its fit,
+    transform and predict calls as `<stage>.<method>` stages"""
+
+    def __init__(self, estimator=None, stage=None):
+        self.estimator = estimator
+        self.stage = stage
+
+    def fit(self, X, y=None, **fit_params):
+        with timed(f'{self.stage}.fit', X.shape[0]):
+            self.estimator.fit(X, y, **fit_params)
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        with timed(f'{self.stage}.fit_transform', X.shape[0]):
+            return self.estimator.fit_transform(X, y, **fit_params)
+
+    def transform(self, X):
+        with timed(f'{self.stage}.transform', X.shape[0]):
+            return self.estimator.transform(X)
+
+    def predict(self, X):
+        with timed(f'{self.stage}.predict', X.shape[0]):
+            return self.estimator.predict(X)
+
+    def __getattr__(self, name):
+        # fitted attributes (n_features_in_, ...) of the wrapped estimator
+        if name.startswith('__') or name in ('estimator', 'stage'):
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+
+def wrap_blocks(blocks):
+    """Wraps the transformers of a list of ColumnTransformer blocks"""
+    return [(name, block if isinstance(block, str) else Timed(block, name),
+             columns) for name, block, columns in blocks]
+
+
+def unwrap(estimator):
+    return estimator.estimator if isinstance(estimator, Timed) else estimator
+
+
+def instrument_pipeline(pipeline):
+    """Returns a shallow copy of a fitted Trainer pipeline whose
+    ColumnTransformer blocks and final estimator are wrapped with Timed;
+    the original pipeline is left untouched"""
+    steps = []
+    for name, step in pipeline.steps:
+        if isinstance(step, ColumnTransformer):
+            step = copy.copy(step)
+            step.transformers_ = wrap_blocks(step.transformers_)
+        elif step is pipeline.steps[-1][1]:
+            step = Timed(step, 'model')
+        steps.append((name, step))
+    return Pipeline(steps)
+
+
+def strip_instrumentation(pipeline):
+    """Returns the pipeline without its Timed wrappers, e.g. before saving it"""
+    steps = []
+    for name, step in pipeline.steps:
+        step = unwrap(step)
+        if isinstance(step, ColumnTransformer):
+            step = copy.copy(step)
+            step.transformers = [(n, unwrap(b), c) for n, b, c in step.transformers]
+            if hasattr(step, 'transformers_'):
+                step.transformers_ = [(n, unwrap(b), c)
+                                      for n, b, c in step.transformers_]
+        steps.append((name, step))
+    return Pipeline(steps)
+
+
+def _labels(stage):
+    return '{stage="%s"}' % stage.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text(prefix='taxifare'):
+    """The recorded metrics in the Prometheus text exposition format"""
+    with _lock:
+        metrics = {stage: copy.deepcopy(m) for stage, m in _metrics.items()}
+    lines = [f'# HELP {prefix}_stage_seconds Duration of each stage',
+             f'# TYPE {prefix}_stage_seconds histogram']
+    for stage, m in sorted(metrics.items()):
+        labels = _labels(stage)
+        cumulative = np.cumsum(m.buckets)
+        for bound, count in zip(BUCKETS + ['+Inf'], cumulative):
+            le = bound if bound == '+Inf' else f'{bound:g}'
+            lines.append(f'{prefix}_stage_seconds_bucket'
+                         f'{labels[:-1]},le="{le}"}} {count}')
+        lines.append(f'{prefix}_stage_seconds_sum{labels} {m.seconds}')
+        lines.append(f'{prefix}_stage_seconds_count{labels} {m.count}')
+    lines += [f'# HELP {prefix}_stage_rows_total Rows processed by each stage',
+              f'# TYPE {prefix}_stage_rows_total counter']
+    for stage, m in sorted(metrics.items()):
+        lines.append(f'{prefix}_stage_rows_total{_labels(stage)} {m.rows}')
+    return '\n'.join(lines) + '\n'
+
+
+def report():
+    """Summary table of the recorded stages, slowest total first"""
+    with _lock:
+        metrics = sorted(_metrics.items(), key=lambda item: -item[1].seconds)
+    lines = [f'{"stage":<45} {"calls":>7} {"rows":>11} {"total s":>9} '
+             f'{"mean ms":>9} {"p95 ms":>9}']
+    for stage, m in metrics:
+        lines.append(f'{stage:<45} {m.count:>7} {m.rows:>11} {m.seconds:>9.3f} '
+                     f'{m.seconds / m.count * 1000:>9.2f} '
+                     f'{m.quantile(0.95) * 1000:>9.2f}')
+    return '\n'.join(lines)
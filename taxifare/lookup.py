@@ -0,0 +1,303 @@
+import calendar
+import json
+import math
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytz
+
+LOOKUP_PATH = os.environ.get(
+    'LOOKUP_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'joblib', 'lookup.json'))
+# the box clean_df keeps trips in: lat_min, lat_max, lon_min, lon_max
+BOUNDS = (40, 42, -74.3, -72.9)
+# the table size grows with the square of the number of cells, so tables
+# default to the city core at a fine resolution rather than the whole box
+# at a coarse one; trips outside are scored by the model
+CORE_BOUNDS = (40.55, 40.95, -74.1, -73.7)
+TIME_ZONE = 'America/New_York'
+# weekdays, saturday, sunday
+DAY_GROUPS = ((0, 1, 2, 3, 4), (5,), (6,))
+REPORT_RESOLUTIONS = (0.04, 0.02, 0.01)
+
+
+def read_manifest(path=LOOKUP_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def values_path(path, build_id):
+    '''the values of a build are stored next to the manifest at path, in a
+    file of their own, so a new build never overwrites the values in use'''
+    return f'{os.path.splitext(path)[0]}.{build_id}.npy'
+
+
+class FareTable():
+    """Fares of a fitted pipeline precomputed over a spatial grid, read
+    through a memory-mapped .npy array of shape
+    (pickup cell, dropoff cell, time bucket). A JSON manifest holds the
+    parameters of the table and the name of its values file.
+
+    The bounding box is cut in square cells of `resolution` degrees and the
+    fare of each pair of cells is the model's prediction between the cell
+    centers. Time buckets are a day group (DAY_GROUPS) times a range of
+    hours_per_bucket local hours. They are evaluated at a representative day
+    and hour of a reference year and month, fixed when the table is built,
+    and trips of any date are looked up by their day group and hour only:
+    the table prices every trip as if it happened in the reference month.
+    A trip outside the box is not in the table: lookup returns None and the
+    caller falls back to the model.
+    """
+
+    def __init__(self, values, meta):
+        self.values = values
+        self.meta = meta
+        self.lat_min, self.lat_max, self.lon_min, self.lon_max = meta['bounds']
+        self.resolution = meta['resolution']
+        self.n_lat, self.n_lon = meta['n_lat'], meta['n_lon']
+        self.hours_per_bucket = meta['hours_per_bucket']
+        self.year, self.month = meta['year'], meta['month']
+        self.model_version = meta.get('model_version')
+        self.hour_buckets = math.ceil(24 / self.hours_per_bucket)
+        self.day_group = np.empty(7, dtype='int64')
+        for group, days in enumerate(meta['day_groups']):
+            self.day_group[list(days)] = group
+
+    @classmethod
+    def load(cls, path=LOOKUP_PATH, meta=None):
+        '''loads the table published at path, meta being its manifest when
+        it was already read'''
+        meta = meta or read_manifest(path)
+        values = np.load(values_path(path, meta['build_id']), mmap_mode='r')
+        return cls(values, meta)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def cell(self, lat, lon):
+        '''index of the cell of a point, or None outside the box'''
+        if not (self.lat_min <= lat <= self.lat_max and
+                self.lon_min <= lon <= self.lon_max):
+            return None
+        i = min(int((lat - self.lat_min) / self.resolution), self.n_lat - 1)
+        j = min(int((lon - self.lon_min) / self.resolution), self.n_lon - 1)
+        return i * self.n_lon + j
+
+    def bucket(self, local):
+        '''time bucket of a local datetime, whatever its date'''
+        return int(self.day_group[local.weekday()]) * self.hour_buckets + \
+            local.hour // self.hours_per_bucket
+
+    def lookup(self, pickup_latitude, pickup_longitude, dropoff_latitude,
+               dropoff_longitude, local):
+        '''fare of one trip, local being its naive local pickup datetime.
+        Returns None when the trip is not in the table.'''
+        pickup = self.cell(pickup_latitude, pickup_longitude)
+        dropoff = self.cell(dropoff_latitude, dropoff_longitude)
+        if pickup is None or dropoff is None:
+            return None
+        return float(self.values[pickup, dropoff, self.bucket(local)])
+
+    def cells(self, lat, lon):
+        '''vectorized cell: -1 outside the box'''
+        lat, lon = np.asarray(lat, dtype='float64'), np.asarray(lon, dtype='float64')
+        i = np.minimum(((lat - self.lat_min) / self.resolution).astype('int64'),
+                       self.n_lat - 1)
+        j = np.minimum(((lon - self.lon_min) / self.resolution).astype('int64'),
+                       self.n_lon - 1)
+        inside = (lat >= self.lat_min) & (lat <= self.lat_max) & \
+            (lon >= self.lon_min) & (lon <= self.lon_max)
+        return np.where(inside, i * self.n_lon + j, -1)
+
+    def lookup_many(self, X):
+        '''fares of a DataFrame of trips with the pipeline's columns (UTC
+        pickup_datetime), NaN for the trips not in the table'''
+        local = pd.DatetimeIndex(pd.to_datetime(X['pickup_datetime'], utc=True))\
+            .tz_convert(TIME_ZONE)
+        pickup = self.cells(X['pickup_latitude'], X['pickup_longitude'])
+        dropoff = self.cells(X['dropoff_latitude'], X['dropoff_longitude'])
+        bucket = self.day_group[local.weekday] * self.hour_buckets + \
+            local.hour // self.hours_per_bucket
+        found = (pickup >= 0) & (dropoff >= 0)
+        fares = np.full(len(X), np.nan)
+        fares[found] = self.values[pickup[found], dropoff[found],
+                                   np.asarray(bucket)[found]]
+        return fares
+
+
+def bucket_times(year, month, hours_per_bucket=4, day_groups=DAY_GROUPS):
+    '''UTC pickup_datetime strings of the representative time of each bucket:
+    the first day of the month in the day group, in the middle of the hours'''
+    tz = pytz.timezone(TIME_ZONE)
+    first_weekday, n_days = calendar.monthrange(year, month)
+    times = []
+    for days in day_groups:
+        day = 1 + min((weekday - first_weekday) % 7 for weekday in days)
+        for start in range(0, 24, hours_per_bucket):
+            hour = min(start + hours_per_bucket // 2, 23)
+            local = tz.localize(datetime(year, month, day, hour, 30))
+            times.append(local.astimezone(pytz.utc)
+                         .strftime('%Y-%m-%d %H:%M:%S UTC'))
+    return times
+
+
+def cell_centers(n_lat, n_lon, bounds, resolution):
+    lat = bounds[0] + (np.arange(n_lat) + 0.5) * resolution
+    lon = bounds[2] + (np.arange(n_lon) + 0.5) * resolution
+    lat, lon = np.meshgrid(np.minimum(lat, bounds[1]), np.minimum(lon, bounds[3]),
+                           indexing='ij')
+    return lat.ravel(), lon.ravel()
+
+
+def _predict_cells(model, path, centers, times, start, stop):
+    '''scores the pickup cells start to stop against every dropoff cell and
+    time bucket and writes them into the preallocated table'''
+    lat, lon = centers
+    n_cells, n_buckets = len(lat), len(times)
+    pickup = np.repeat(np.arange(start, stop), n_cells * n_buckets)
+    dropoff = np.tile(np.repeat(np.arange(n_cells), n_buckets), stop - start)
+    X = pd.DataFrame(dict(
+        key='table',
+        pickup_datetime=np.tile(times, (stop - start) * n_cells),
+        pickup_longitude=lon[pickup], pickup_latitude=lat[pickup],
+        dropoff_longitude=lon[dropoff], dropoff_latitude=lat[dropoff],
+        passenger_count=1))
+    out = np.load(path, mmap_mode='r+')
+    out[start:stop] = model.predict(X).reshape(stop - start, n_cells, n_buckets)
+    out.flush()
+
+
+def build_table(model, year, month, path=LOOKUP_PATH, resolution=0.02,
+                bounds=CORE_BOUNDS, hours_per_bucket=4, day_groups=DAY_GROUPS,
+                dtype='float32', model_version=None, n_jobs=-1,
+                rows_per_job=500_000):
+    '''evaluates a fitted pipeline over every pair of grid cells and time
+    bucket of the given reference month, in parallel batches of pickup
+    cells, and publishes the table at path. There is no default month: the
+    model only knows the years it was trained on, so the month should be one
+    it can price (e.g. the last month of the training data). float16 values
+    halve the size of the table, but are stored in steps of 6 cents above
+    $64, coarser than the cents the API returns.
+    model_version should be the serving registry's version of the model
+    file: the API only uses a table built for the model it serves.
+    The values are written to a new file and the manifest, which names
+    it, is replaced last in one rename, so readers see either the old or
+    the new table. Returns the loaded FareTable.'''
+    n_lat = math.ceil(round((bounds[1] - bounds[0]) / resolution, 6))
+    n_lon = math.ceil(round((bounds[3] - bounds[2]) / resolution, 6))
+    centers = cell_centers(n_lat, n_lon, bounds, resolution)
+    times = bucket_times(year, month, hours_per_bucket, day_groups)
+    n_cells = n_lat * n_lon
+
+    start_time = time.perf_counter()
+    build_id = uuid.uuid4().hex[:12]
+    values = values_path(path, build_id)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.lib.format.open_memmap(values, mode='w+', dtype=dtype,
+                              shape=(n_cells, n_cells, len(times))).flush()
+    cells_per_job = max(rows_per_job // (n_cells * len(times)), 1)
+    joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_predict_cells)(model, values, centers, times, start,
+                                       min(start + cells_per_job, n_cells))
+        for start in range(0, n_cells, cells_per_job))
+    meta = dict(build_id=build_id, bounds=list(bounds), resolution=resolution,
+                n_lat=n_lat, n_lon=n_lon, year=year, month=month,
+                hours_per_bucket=hours_per_bucket,
+                day_groups=[list(days) for days in day_groups],
+                model_version=model_version,
+                build_seconds=round(time.perf_counter() - start_time, 3))
+    tmp = f'{path}.{build_id}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    previous = None
+    if os.path.isfile(path):
+        previous = read_manifest(path).get('build_id')
+    os.replace(tmp, path)
+    if previous is not None and previous != build_id:
+        # a reader which loaded the old manifest just before may fail to
+        # open these values and retries, see app.lookup.LookupTier
+        try:
+            os.remove(values_path(path, previous))
+        except OSError:
+            pass
+    return FareTable.load(path)
+
+
+def evaluate_table(table, model, X):
+    '''compares the table with the model on the trips of X, in $. Only the
+    trips in the table count towards the errors, coverage is their share.'''
+    fares = table.lookup_many(X)
+    found = ~np.isnan(fares)
+    if not found.any():
+        return dict(coverage=0.0, mae=None, p95=None, max=None)
+    errors = np.abs(fares[found] - model.predict(X[found]))
+    return dict(coverage=round(float(found.mean()), 4),
+                mae=round(float(errors.mean()), 4),
+                p95=round(float(np.quantile(errors, 0.95)), 4),
+                max=round(float(errors.max()), 4))
+
+
+def report_trips(df, year, month, seed=0):
+    '''trips to evaluate a table on: the locations of df with pickup times
+    drawn uniformly in the table's reference month'''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(year=year, month=month, day=1, tz=TIME_ZONE)
+    seconds = (start + pd.offsets.MonthBegin(1) - start).total_seconds()
+    local = start + pd.to_timedelta(rng.uniform(0, seconds, len(df)).astype('int64'),
+                                    unit='s')
+    X = df.drop(columns=['fare_amount'], errors='ignore').copy()
+    X['pickup_datetime'] = local.tz_convert('UTC')\
+        .strftime('%Y-%m-%d %H:%M:%S UTC')
+    return X
+
+
+def resolution_report(model, df, year, month, resolutions=REPORT_RESOLUTIONS,
+                      directory=None, **kwargs):
+    '''builds a table per resolution (in a temporary directory unless one is
+    given) and returns a DataFrame of their size, build time and error
+    against the model on the locations of df'''
+    import tempfile
+
+    directory = directory or tempfile.mkdtemp()
+    rows = []
+    for resolution in resolutions:
+        table = build_table(model, year, month,
+                            os.path.join(directory, f'lookup_{resolution}.json'),
+                            resolution=resolution, **kwargs)
+        X = report_trips(df, year, month)
+        rows.append(dict(resolution=resolution, cells=table.n_lat * table.n_lon,
+                         buckets=table.values.shape[2],
+                         size_mb=round(table.nbytes / 2 ** 20, 1),
+                         build_s=table.meta['build_seconds'],
+                         **evaluate_table(table, model, X)))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # python -m taxifare.lookup build <year> <month> [resolution]
+    # python -m taxifare.lookup report <year> <month> [resolution ...]
+    from app.registry import ModelRegistry
+    from taxifare.data import clean_df, get_data
+
+    command, year, month = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    loaded = ModelRegistry().get()
+    model = loaded.model
+    if command == 'build':
+        resolution = float(sys.argv[4]) if len(sys.argv) > 4 else 0.02
+        table = build_table(model, year, month, resolution=resolution,
+                            model_version=loaded.version)
+        print(f'{LOOKUP_PATH}: {table.values.shape}, '
+              f'{table.nbytes / 2 ** 20:.1f} MB in '
+              f'{table.meta["build_seconds"]}s')
+    else:
+        df = clean_df(get_data(10_000, sample='reservoir'))
+        resolutions = [float(r) for r in sys.argv[4:]] or REPORT_RESOLUTIONS
+        print(resolution_report(model, df, year, month, resolutions)
+              .to_string(index=False))
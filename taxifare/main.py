@@ -1,7 +1,11 @@
+import sys
+
 from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import SGDRegressor
 from sklearn.model_selection import train_test_split
 
-from taxifare.data import clean_df, get_data
+from taxifare import instrumentation
+from taxifare.data import clean_df, get_data, split_chunks
 from taxifare.trainer import Trainer
 
 
@@ -11,8 +15,68 @@ params = dict(nrows=10000,
                 mlflow_online=False,
                 joblib_dump=True)
 
+# out-of-core training and evaluation on the whole file, the holdout set is
+# chosen by a hash of the key so it never needs to be materialized
+streaming_params = dict(nrows=None,
+                        chunksize=500_000,
+                        holdout=0.15,
+                        model=SGDRegressor(),
+                        dist_encoder='both',
+                        mlflow_online=False,
+                        joblib_dump=True)
+
+
+def run_streaming(**params):
+    def chunks(holdout=False):
+        return split_chunks(get_data(**params), holdout=holdout,
+                            fraction=params['holdout'])
+
+    trainer = Trainer(None, None, **params)
+    trainer.run_incremental(chunks)
+    metrics = trainer.evaluate_stream(chunks(holdout=True), n_jobs=-1)
+    return trainer, metrics
+
+
+# successive halving over taxifare.sweep.default_search_space()
+search_params = dict(nrows=1_000_000,
+                     n_candidates=24,
+                     min_rows=10_000,
+                     budget=1800,
+                     mlflow_online=False)
+
+
+def run_search(**params):
+    df = clean_df(get_data(nrows=params['nrows']))
+    X = df.drop("fare_amount", axis=1)
+    y = df["fare_amount"]
+    trainer = Trainer(X, y, **params)
+    leaderboard = trainer.search(n_candidates=params['n_candidates'],
+                                 min_rows=params['min_rows'],
+                                 budget=params['budget'])
+    return trainer, leaderboard
+
 
 if __name__ == "__main__":
+    # python -m taxifare.main [streaming|search]
+    if sys.argv[1:] == ['streaming']:
+        trainer, metrics = run_streaming(**streaming_params)
+        trainer.save_model()
+        print(f'rmse: {metrics["rmse"]};',
+                f'mae: {metrics["mae"]};',
+                f'dist_encoder: {trainer.dist_encoder};',
+                f'model: {trainer.model_name};')
+        if instrumentation.enabled():
+            print(instrumentation.report())
+        sys.exit()
+
+    if sys.argv[1:] == ['search']:
+        trainer, leaderboard = run_search(**search_params)
+        trainer.save_model()
+        print(leaderboard.to_string())
+        print(f'best: {trainer.model_name}{trainer.model_params};',
+                f'dist_encoder: {trainer.dist_encoder};')
+        sys.exit()
+
     df = get_data(**params)
     df = clean_df(df)
     X = df.drop("fare_amount", axis=1)
@@ -25,3 +89,6 @@ if __name__ == "__main__":
     print(f'rmse: {rmse};',
             f'dist_encoder: {trainer.dist_encoder};',
             f'model: {trainer.model_name};')
+    # python -m taxifare.main with TAXIFARE_INSTRUMENT=1
+    if instrumentation.enabled():
+        print(instrumentation.report())
@@ -55,10 +55,12 @@ class Trainer():
     def mlflow_log_metric(self, key, value):
         self.mlflow_client.log_metric(self.mlflow_run.info.run_id, key, value)
 
-for model in ["linear", "randomforest"]:
-    trainer = Trainer(EXPERIMENT_NAME)
-    trainer.mlflow_log_metric("rmse", 5.0)
-    trainer.mlflow_log_param("model", model)
-    trainer.mlflow_log_param("student_name", yourname)
-
-print(f'https://mlflow.lewagon.ai/#/experiments/{trainer.mlflow_experiment_id}')
+# logs to the remote server, only when run as a script
+if __name__ == "__main__":
+    for model in ["linear", "randomforest"]:
+        trainer = Trainer(EXPERIMENT_NAME)
+        trainer.mlflow_log_metric("rmse", 5.0)
+        trainer.mlflow_log_param("model", model)
+        trainer.mlflow_log_param("student_name", yourname)
+
+    print(f'https://mlflow.lewagon.ai/#/experiments/{trainer.mlflow_experiment_id}')
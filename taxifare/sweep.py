@@ -0,0 +1,275 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing.connection import wait
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from taxifare.encoders import NYC_CENTER, TimeFeaturesEncoder
+from taxifare.utils import compute_rmse, distance_features
+
+FEATURE_BLOCKS = {'dist': ['distance'],
+                  'dist_to_center': ['pickup_distance_to_center',
+                                     'dropoff_distance_to_center'],
+                  'time': ['dow', 'hour', 'month', 'year']}
+DIST_ENCODER_BLOCKS = {'dist': ['dist', 'time'],
+                       'dist_to_center': ['dist_to_center', 'time'],
+                       'both': ['dist', 'dist_to_center', 'time']}
+
+
+def compute_features(X):
+    '''computes all feature blocks as one float64 array, columns ordered as
+    in FEATURE_BLOCKS; the three distances are computed in one fused pass'''
+    features = np.empty((len(X), len(feature_columns())))
+    distance_features(X['pickup_latitude'].to_numpy(),
+                      X['pickup_longitude'].to_numpy(),
+                      X['dropoff_latitude'].to_numpy(),
+                      X['dropoff_longitude'].to_numpy(),
+                      NYC_CENTER, out=features[:, :3])
+    features[:, 3:] = TimeFeaturesEncoder().transform(X)
+    return features
+
+
+def feature_columns():
+    return [column for block in FEATURE_BLOCKS.values() for column in block]
+
+
+def cache_features(X_train, X_val, cache_dir):
+    '''computes the train and validation features once and dumps them in
+    cache_dir, keyed by a hash of the data; returns the file path'''
+    key = joblib.hash((pd.util.hash_pandas_object(X_train).to_numpy(),
+                       pd.util.hash_pandas_object(X_val).to_numpy()))
+    path = os.path.join(cache_dir, f'features_{key}.joblib')
+    if not os.path.isfile(path):
+        joblib.dump(dict(train=compute_features(X_train),
+                         val=compute_features(X_val)), path)
+    return path
+
+
+def feature_pipeline(model, dist_encoder='both'):
+    '''the Trainer preprocessing applied to precomputed feature columns'''
+    columns = feature_columns()
+    postprocessors = {'dist': StandardScaler(),
+                      'dist_to_center': StandardScaler(),
+                      'time': OneHotEncoder(handle_unknown='ignore')}
+    blocks = [(name, postprocessors[name],
+               [columns.index(column) for column in FEATURE_BLOCKS[name]])
+              for name in DIST_ENCODER_BLOCKS[dist_encoder]]
+    return make_pipeline(ColumnTransformer(blocks, remainder='drop'), model)
+
+
+def _run_job(conn, features_path, y_train, y_val, model, dist_encoder,
+             n_rows=None, seed=0):
+    try:
+        features = joblib.load(features_path, mmap_mode='r')
+        X_train = features['train']
+        if n_rows is not None and n_rows < len(y_train):
+            # the first n_rows of a fixed permutation: the subsets of
+            # successive halving rungs are nested
+            rows = np.sort(np.random.default_rng(seed).permutation(
+                len(y_train))[:n_rows])
+            X_train, y_train = X_train[rows], y_train[rows]
+        pipeline = feature_pipeline(model, dist_encoder)
+        start = time.perf_counter()
+        pipeline.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        y_pred = pipeline.predict(features['val'])
+        predict_seconds = time.perf_counter() - start
+        conn.send(dict(status='ok', rmse=compute_rmse(y_pred, y_val),
+                       fit_seconds=fit_seconds,
+                       predict_seconds=predict_seconds))
+    except Exception as e:
+        conn.send(dict(status=f'error: {e!r}'))
+    finally:
+        conn.close()
+
+
+def _run_processes(jobs, n_jobs=None, timeout=None, deadline=None):
+    '''runs _run_job for each tuple of arguments in jobs, each in its own
+    process with at most n_jobs (default: CPU count) at a time. Jobs running
+    longer than timeout seconds are killed, as are the jobs still running or
+    pending at the time.monotonic() deadline. Returns one result dict per
+    job, in order.'''
+    n_workers = min(n_jobs or os.cpu_count() or 1, max(len(jobs), 1))
+    results = [None] * len(jobs)
+    pending, running = list(range(len(jobs))), {}
+    try:
+        while pending or running:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            while pending and len(running) < n_workers:
+                index = pending.pop(0)
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_run_job,
+                                                  args=(child_conn,) + jobs[index])
+                process.start()
+                child_conn.close()
+                running[parent_conn] = (index, process, time.monotonic())
+
+            for conn in wait(list(running), timeout=0.1):
+                index, process, _ = running.pop(conn)
+                try:
+                    results[index] = conn.recv()
+                except EOFError:
+                    process.join()
+                    results[index] = dict(status=f'error: exit code {process.exitcode}')
+                process.join()
+            if timeout is not None:
+                for conn, (index, process, started) in list(running.items()):
+                    if time.monotonic() - started > timeout:
+                        process.terminate()
+                        process.join()
+                        results[index] = dict(status='timeout')
+                        del running[conn]
+    finally:
+        for index, process, _ in running.values():
+            process.terminate()
+            process.join()
+            results[index] = dict(status='budget exceeded')
+    return [result or dict(status='budget exceeded') for result in results]
+
+
+def model_description(model):
+    '''(name, params) strings as logged by the Trainer'''
+    return (str(model).lower()[:str(model).find('(')],
+            str(model)[str(model).find('('):])
+
+
+def run_sweep(X_train, y_train, X_val, y_val, models,
+              dist_encoders=('dist', 'dist_to_center', 'both'),
+              n_jobs=None, timeout=None, cache_dir=None):
+    '''fits every model x dist_encoder combination on features computed once,
+    each job in its own process with at most n_jobs (default: CPU count)
+    running at a time. Jobs running longer than timeout seconds are killed;
+    failed or timed out jobs are reported in the status column and do not
+    stop the sweep. Returns a DataFrame sorted by rmse.'''
+    tmp_dir = None
+    if cache_dir is None:
+        cache_dir = tmp_dir = tempfile.mkdtemp(prefix='taxifare_sweep_')
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        features_path = cache_features(X_train, X_val, cache_dir)
+        y_train, y_val = np.asarray(y_train), np.asarray(y_val)
+        jobs = [(model, dist_encoder) for model in models
+                for dist_encoder in dist_encoders]
+        results = _run_processes(
+            [(features_path, y_train, y_val) + job for job in jobs],
+            n_jobs=n_jobs, timeout=timeout)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    rows = []
+    for (model, dist_encoder), result in zip(jobs, results):
+        model_name, params = model_description(model)
+        rows.append({'model': model_name, 'params': params,
+                     'dist_encoder': dist_encoder, 'rmse': np.nan,
+                     'fit_seconds': np.nan, 'predict_seconds': np.nan,
+                     **result})
+    return pd.DataFrame(rows).sort_values('rmse').reset_index(drop=True)
+
+
+def default_search_space():
+    '''model families and their parameter lists for successive_halving,
+    dist_encoder is searched for every family'''
+    from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+    from sklearn.linear_model import Lasso, Ridge
+
+    return {'ridge': (Ridge(), {'alpha': [0.01, 0.1, 1.0, 10.0]}),
+            'lasso': (Lasso(), {'alpha': [0.001, 0.01, 0.05, 0.1]}),
+            'randomforest': (RandomForestRegressor(n_jobs=1), {
+                'n_estimators': [50, 100, 200],
+                'max_depth': [None, 10, 20],
+                'min_samples_leaf': [1, 5, 20]}),
+            'gradientboosting': (GradientBoostingRegressor(), {
+                'n_estimators': [100, 200, 400],
+                'learning_rate': [0.05, 0.1, 0.2],
+                'max_depth': [3, 5, 7]})}
+
+
+def sample_candidates(search_space, n_candidates, seed=0):
+    '''draws n_candidates (model, dist_encoder) pairs spread evenly over the
+    families of the search space'''
+    from sklearn.base import clone
+    from sklearn.model_selection import ParameterSampler
+
+    families = list(search_space.items())
+    candidates = []
+    for i, (name, (estimator, space)) in enumerate(families):
+        n_family = n_candidates // len(families) + \
+            (i < n_candidates % len(families))
+        space = {'dist_encoder': list(DIST_ENCODER_BLOCKS), **space}
+        for params in ParameterSampler(space, max(n_family, 0),
+                                       random_state=seed + i):
+            params = dict(params)
+            dist_encoder = params.pop('dist_encoder')
+            candidates.append((clone(estimator).set_params(**params),
+                               dist_encoder))
+    return candidates
+
+
+def successive_halving(X_train, y_train, X_val, y_val, search_space=None,
+                       n_candidates=24, min_rows=10_000, factor=3, n_jobs=None,
+                       budget=None, seed=0, cache_dir=None):
+    '''budgeted search over the candidates of search_space (see
+    default_search_space): every candidate is fitted on min_rows training
+    rows, the best 1/factor are refitted on factor times more rows, and so
+    on until the last rung uses all the rows. Features are computed once and
+    shared by all the fits, which run in parallel processes. Once budget
+    seconds have elapsed the running fits are killed and no rung is started.
+    Returns the leaderboard, one row per fit sorted by rung then rmse, and
+    the (model, dist_encoder) of the best candidate of the last rung.'''
+    deadline = time.monotonic() + budget if budget is not None else None
+    candidates = sample_candidates(search_space or default_search_space(),
+                                   n_candidates, seed)
+    tmp_dir = None
+    if cache_dir is None:
+        cache_dir = tmp_dir = tempfile.mkdtemp(prefix='taxifare_search_')
+    os.makedirs(cache_dir, exist_ok=True)
+    y_train, y_val = np.asarray(y_train), np.asarray(y_val)
+    rows, best = [], None
+    try:
+        features_path = cache_features(X_train, X_val, cache_dir)
+        remaining, n_rows, rung = list(range(len(candidates))), min_rows, 0
+        while remaining:
+            n_rows = min(n_rows, len(y_train))
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            results = _run_processes(
+                [(features_path, y_train, y_val) + candidates[i] + (n_rows, seed)
+                 for i in remaining], n_jobs=n_jobs, deadline=deadline)
+            scores = []
+            for i, result in zip(remaining, results):
+                model_name, params = model_description(candidates[i][0])
+                rows.append({'candidate': i, 'rung': rung, 'n_rows': n_rows,
+                             'model': model_name, 'params': params,
+                             'dist_encoder': candidates[i][1], 'rmse': np.nan,
+                             'fit_seconds': np.nan, 'predict_seconds': np.nan,
+                             **result})
+                if result['status'] == 'ok':
+                    scores.append((result['rmse'], i))
+            if not scores:
+                break
+            scores.sort()
+            best = candidates[scores[0][1]]
+            if n_rows >= len(y_train) or len(scores) == 1:
+                break
+            remaining = [i for _, i in scores[:max(len(scores) // factor, 1)]]
+            n_rows, rung = n_rows * factor, rung + 1
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    leaderboard = pd.DataFrame(rows)
+    if len(leaderboard):
+        leaderboard = leaderboard.sort_values(['rung', 'rmse'],
+                                              ascending=[False, True])
+    return leaderboard.reset_index(drop=True), best
@@ -0,0 +1,162 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+MLFLOW_URI = "https://mlflow.lewagon.ai/"
+# used when mlflow_online is False and MLFLOW_TRACKING_URI is not set
+LOCAL_TRACKING_URI = 'file://' + os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'mlruns'))
+FLUSH_INTERVAL = float(os.environ.get('MLFLOW_FLUSH_INTERVAL', 2))
+# log_batch limits of the tracking server
+MAX_PARAMS_PER_BATCH = 100
+MAX_METRICS_PER_BATCH = 1000
+
+_FLUSH, _STOP = object(), object()
+
+
+def tracking_uri(mlflow_online=False):
+    """The lewagon server when online, else MLFLOW_TRACKING_URI or the
+    local file store"""
+    if mlflow_online:
+        return MLFLOW_URI
+    return os.environ.get('MLFLOW_TRACKING_URI', LOCAL_TRACKING_URI)
+
+
+class BufferedRun():
+    """Handle on a run created lazily by the logger's background thread.
+    log_param and log_metric only queue the values."""
+
+    def __init__(self, logger, experiment_name):
+        self.logger = logger
+        self.experiment_name = experiment_name
+        self.run_id = None
+
+    def log_param(self, key, value):
+        self.logger.put(self, ('param', key, str(value)))
+
+    def log_metric(self, key, value, step=0):
+        self.logger.put(self, ('metric', key, float(value),
+                               int(time.time() * 1000), step))
+
+    def wait(self):
+        """Flushes the logger and returns the run id"""
+        self.logger.flush()
+        return self.run_id
+
+
+class AsyncMlflowLogger():
+    """Sends params and metrics to MLflow from a background thread.
+
+    Values are buffered for up to flush_interval seconds and sent with one
+    log_batch call per run; runs and experiments are created on the same
+    thread, so logging never waits on the tracking server. Errors are
+    printed and the values dropped, tracking never stops a training.
+    Pending values are flushed at exit. mlflow itself is imported by the
+    background thread, so importing this module stays cheap.
+    """
+
+    def __init__(self, tracking_uri=LOCAL_TRACKING_URI,
+                 flush_interval=FLUSH_INTERVAL):
+        self.tracking_uri = tracking_uri
+        self.flush_interval = flush_interval
+        self._client = None
+        self._queue = queue.Queue()
+        self._experiment_ids = {}
+        self._experiment_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def start_run(self, experiment_name):
+        return BufferedRun(self, experiment_name)
+
+    def put(self, run, item):
+        self._queue.put((run, item))
+
+    def flush(self):
+        """Blocks until everything logged so far has been sent"""
+        if self._thread.is_alive():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._queue.join()
+            self._thread.join()
+
+    @property
+    def client(self):
+        if self._client is None:
+            from mlflow.tracking import MlflowClient
+            self._client = MlflowClient(tracking_uri=self.tracking_uri)
+        return self._client
+
+    def experiment_id(self, experiment_name):
+        with self._experiment_lock:
+            return self._get_experiment_id(experiment_name)
+
+    def _get_experiment_id(self, experiment_name):
+        if experiment_name not in self._experiment_ids:
+            experiment = self.client.get_experiment_by_name(experiment_name)
+            self._experiment_ids[experiment_name] = \
+                experiment.experiment_id if experiment is not None else \
+                self.client.create_experiment(experiment_name)
+        return self._experiment_ids[experiment_name]
+
+    def _work(self):
+        stop = False
+        while not stop:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while items[-1] is not _FLUSH and items[-1] is not _STOP:
+                try:
+                    items.append(self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            stop = items[-1] is _STOP
+            try:
+                self._send([item for item in items
+                            if item is not _FLUSH and item is not _STOP])
+            except Exception as e:
+                print(f'mlflow logging failed, dropping {len(items)} values: {e!r}')
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _send(self, items):
+        from mlflow.entities import Metric, Param
+
+        runs = {}
+        for run, (kind, key, *value) in items:
+            params, metrics = runs.setdefault(run, ({}, []))
+            if kind == 'param':
+                params[key] = Param(key, *value)
+            else:
+                metrics.append(Metric(key, *value))
+        for run, (params, metrics) in runs.items():
+            if run.run_id is None:
+                run.run_id = self.client.create_run(
+                    self.experiment_id(run.experiment_name)).info.run_id
+            params = list(params.values())
+            while params or metrics:
+                self.client.log_batch(run.run_id,
+                                      metrics=metrics[:MAX_METRICS_PER_BATCH],
+                                      params=params[:MAX_PARAMS_PER_BATCH])
+                params = params[MAX_PARAMS_PER_BATCH:]
+                metrics = metrics[MAX_METRICS_PER_BATCH:]
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_logger(uri):
+    """One shared logger (and background thread) per tracking URI"""
+    with _loggers_lock:
+        if uri not in _loggers:
+            _loggers[uri] = AsyncMlflowLogger(uri)
+        return _loggers[uri]
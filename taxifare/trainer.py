@@ -1,21 +1,34 @@
 import joblib
-import mlflow
-import pandas as pd
+import numpy as np
+from taxifare.artifacts import save_artifact
 from taxifare.data import get_data, clean_df
 from taxifare.encoders import TimeFeaturesEncoder, DistanceTransformer, DistanceToCenter
-from taxifare.utils import compute_rmse
+from taxifare.features import FeatureMatrixEncoder, FeatureStore
+from taxifare import instrumentation
+from taxifare.sweep import (feature_pipeline, model_description, run_sweep,
+                            successive_halving)
+from taxifare.tracking import get_logger, tracking_uri
+from taxifare.utils import ErrorAccumulator, compute_rmse
 from memoized_property import memoized_property
-from mlflow.tracking import MlflowClient
 from sklearn.compose import ColumnTransformer
-from sklearn.svm import SVR
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
-from sklearn.linear_model import Lasso, Ridge, LinearRegression
-from sklearn.model_selection import train_test_split, RandomizedSearchCV
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
 
-MLFLOW_URI = "https://mlflow.lewagon.ai/"
 EXPERIMENT_NAME = '[SG] [Singapore] [marcustan-94] taxifare v0'
+# known values of the time features, used as fixed one-hot categories when
+# training incrementally since a single chunk may not contain all of them
+TIME_CATEGORIES = [list(range(7)), list(range(24)), list(range(1, 13)),
+                   list(range(2009, 2016))]
+
+
+def _chunk_errors(pipeline, edges, chunk, target):
+    """scores one chunk for Trainer.evaluate_stream"""
+    return ErrorAccumulator(edges).update(
+        pipeline.predict(chunk.drop(columns=target)),
+        chunk[target].to_numpy(),
+        TimeFeaturesEncoder().transform(chunk)['hour'],
+        DistanceTransformer().transform(chunk)['distance'])
+
 
 class Trainer():
     def __init__(self, X, y, **kwargs):
@@ -33,10 +46,14 @@ class Trainer():
         self.dist_encoder = kwargs.get('dist_encoder', 'both')
         self.mlflow_online = kwargs.get('mlflow_online', False)
         self.joblib_dump = kwargs.get('joblib_dump', False)
+        self.n_jobs = kwargs.get('n_jobs', None)
         self.experiment_name = EXPERIMENT_NAME
 
-    def set_pipeline(self):
-        """defines the pipeline as a class attribute"""
+    def set_pipeline(self, instrument=None):
+        """defines the pipeline as a class attribute; the feature blocks run
+        in parallel when the n_jobs kwarg is given. When instrumentation is
+        enabled each block and the model are timed (see
+        taxifare.instrumentation)"""
         distance_cols = ["pickup_latitude", "pickup_longitude",
                          'dropoff_latitude', 'dropoff_longitude']
         time_cols = ['pickup_datetime']
@@ -58,49 +75,166 @@ class Trainer():
         elif self.dist_encoder == 'dist_to_center':
             feat_eng_blocks.pop(0)
 
-        preproc_pipe = ColumnTransformer(feat_eng_blocks, remainder="drop")
-        self.pipeline = make_pipeline(preproc_pipe, self.model)
+        model = self.model
+        if instrument is None:
+            instrument = instrumentation.enabled()
+        if instrument:
+            feat_eng_blocks = instrumentation.wrap_blocks(feat_eng_blocks)
+            model = instrumentation.Timed(model, 'model')
+
+        preproc_pipe = ColumnTransformer(feat_eng_blocks, remainder="drop",
+                                         n_jobs=self.n_jobs)
+        self.pipeline = make_pipeline(preproc_pipe, model)
 
     def run(self):
         """Sets and train the pipeline"""
         self.set_pipeline()
         self.pipeline.fit(self.X, self.y)
 
+    def run_incremental(self, chunks, target='fare_amount', n_epochs=1):
+        """Sets and trains the pipeline out of core, one chunk at a time.
+            chunks: callable returning an iterable of cleaned DataFrames,
+                e.g. lambda: get_data(nrows=None, chunksize=100_000).
+                It is called once to fit the scalers with partial_fit and
+                once per epoch to train the model with partial_fit, so
+                memory use only depends on the chunk size.
+        The model must implement partial_fit (e.g. SGDRegressor) and the
+        one-hot encoder uses the TIME_CATEGORIES domains.
+        """
+        if not hasattr(self.model, 'partial_fit'):
+            raise ValueError(f'{self.model_name} does not support partial_fit')
+        # the blocks are accessed directly below, so they are not wrapped
+        self.set_pipeline(instrument=False)
+        self.pipeline.set_params(
+            columntransformer__time__onehotencoder__categories=TIME_CATEGORIES)
+        preproc = self.pipeline.steps[0][1]
+
+        # first pass: fit the scalers, the encoders themselves are stateless;
+        # chunks left empty by the cleaning are skipped in both passes
+        fitted = False
+        for chunk in chunks():
+            if len(chunk) == 0:
+                continue
+            X = chunk.drop(columns=target)
+            if not fitted:
+                preproc.fit(X)
+                fitted = True
+                continue
+            for name, block, columns in preproc.transformers_:
+                if name in ('dist', 'dist_to_center'):
+                    encoder, scaler = block.steps[0][1], block.steps[1][1]
+                    scaler.partial_fit(encoder.transform(X[columns]))
+        if not fitted:
+            raise ValueError('no rows to train on: every chunk is empty')
+
+        # following passes: train the model on the transformed chunks
+        for _ in range(n_epochs):
+            for chunk in chunks():
+                if len(chunk) == 0:
+                    continue
+                X_transformed = preproc.transform(chunk.drop(columns=target))
+                self.model.partial_fit(X_transformed, chunk[target].to_numpy())
+
+    def run_from_store(self, store=None, segments=None):
+        """Trains on the precomputed features of a FeatureStore (default
+        location) instead of raw columns, building its stale blocks first.
+        The trained pipeline starts with a FeatureMatrixEncoder, so it
+        predicts on raw DataFrames like the one fitted by run().
+        """
+        store = store or FeatureStore()
+        store.build()
+        X, y = store.load(segments)
+        model_pipeline = feature_pipeline(self.model, self.dist_encoder)
+        model_pipeline.fit(X, y)
+        self.pipeline = make_pipeline(FeatureMatrixEncoder(), model_pipeline)
+
+    def search(self, search_space=None, n_candidates=24, min_rows=10_000,
+               factor=3, n_jobs=None, budget=None, val_size=0.15, seed=0):
+        """Chooses the model and dist_encoder by successive halving (see
+        taxifare.sweep.successive_halving) on a validation split of X, then
+        fits the pipeline with the winner on all of X, ready for save_model.
+            search_space: {family: (estimator, {param: values})}, defaults
+                to taxifare.sweep.default_search_space()
+            budget: wall-clock seconds for the search, the final fit is not
+                included
+        Returns the leaderboard, also kept as self.leaderboard.
+        """
+        from sklearn.model_selection import train_test_split
+
+        X_train, X_val, y_train, y_val = train_test_split(
+            self.X, self.y, test_size=val_size, random_state=seed)
+        self.leaderboard, best = successive_halving(
+            X_train, y_train, X_val, y_val, search_space=search_space,
+            n_candidates=n_candidates, min_rows=min_rows, factor=factor,
+            n_jobs=n_jobs, budget=budget, seed=seed)
+        if best is None:
+            raise RuntimeError('no candidate could be fitted within the budget')
+        self.model, self.dist_encoder = best
+        self.model_name, self.model_params = model_description(self.model)
+        self.run()
+        return self.leaderboard
+
     def evaluate(self, X_test, y_test):
         """evaluates the pipeline on df_test and return the RMSE"""
         y_pred = self.pipeline.predict(X_test)
         rmse = compute_rmse(y_pred, y_test)
         return rmse
 
+    def evaluate_stream(self, chunks, target='fare_amount', n_jobs=None):
+        """evaluates the pipeline on an iterable of DataFrame chunks with
+        constant memory and returns RMSE, MAE and the errors per hour and per
+        distance decile (deciles estimated on the first non-empty chunk).
+        Chunks are scored in parallel when n_jobs is given."""
+        chunks = (chunk for chunk in chunks if len(chunk))
+        first = next(chunks, None)
+        if first is None:
+            raise ValueError('no rows to evaluate: every chunk is empty')
+        distance = DistanceTransformer().transform(first)['distance']
+        edges = np.quantile(distance, np.linspace(0.1, 0.9, 9))
+
+        # only the pipeline is sent to the workers, not the trainer
+        accumulator = _chunk_errors(self.pipeline, edges, first, target)
+        for chunk_accumulator in joblib.Parallel(n_jobs=n_jobs)(
+                joblib.delayed(_chunk_errors)(self.pipeline, edges, chunk, target)
+                for chunk in chunks):
+            accumulator.merge(chunk_accumulator)
+        return accumulator.results()
+
     @memoized_property
-    def mlflow_client(self, mlflow_online=False):
-        if mlflow_online:
-            mlflow.set_tracking_uri(MLFLOW_URI)
-        return MlflowClient()
+    def mlflow_logger(self):
+        """Background logger shared by all trainers using the same server"""
+        return get_logger(tracking_uri(self.mlflow_online))
 
     @memoized_property
     def mlflow_experiment_id(self):
-        try:
-            return self.mlflow_client.create_experiment(self.experiment_name)
-        except BaseException:
-            return self.mlflow_client.get_experiment_by_name(self.experiment_name).experiment_id
+        return self.mlflow_logger.experiment_id(self.experiment_name)
 
     @memoized_property
     def mlflow_run(self):
-        return self.mlflow_client.create_run(self.mlflow_experiment_id)
+        """Run created in the background on the first flush"""
+        return self.mlflow_logger.start_run(self.experiment_name)
 
     def mlflow_log_param(self, key, value):
-        self.mlflow_client.log_param(self.mlflow_run.info.run_id, key, value)
+        self.mlflow_run.log_param(key, value)
 
     def mlflow_log_metric(self, key, value):
-        self.mlflow_client.log_metric(self.mlflow_run.info.run_id, key, value)
+        self.mlflow_run.log_metric(key, value)
 
-    def save_model(self, joblib_dump=False):
-        """ Save the trained model into a model.joblib file """
-        joblib.dump(self.pipeline, f'joblib/{str(self.model_name)}.joblib')
+    def save_model(self, joblib_dump=False, artifact='joblib'):
+        """ Save the trained model into a model.joblib file
+            artifact: 'joblib', 'compressed' or 'flat' (tree ensembles only),
+            see taxifare.artifacts.save_artifact
+        """
+        save_artifact(instrumentation.strip_instrumentation(self.pipeline),
+                      f'joblib/{str(self.model_name)}.joblib', artifact)
 
 
 if __name__ == "__main__":
+    from sklearn.svm import SVR
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.linear_model import Lasso, Ridge, LinearRegression
+    from sklearn.model_selection import train_test_split
+
     df = get_data()
     df_clean = clean_df(df)
     X = df_clean.drop('fare_amount', axis=1)
@@ -116,30 +250,25 @@ if __name__ == "__main__":
                   ]
     dist_encoder_list = ['dist', 'dist_to_center', 'both']
 
-    for model in model_list:
-        for dist_encoder in dist_encoder_list:
-            params = dict(nrows=10000,
-                          model=model,
-                          dist_encoder=dist_encoder,
-                          mlflow_online=False,
-                          joblib_dump=False)
-            trainer = Trainer(X_train, y_train, **params)
-            trainer.run()
-            rmse = trainer.evaluate(X_val, y_val)
-            print(f'rmse: {rmse};',
-                  f'dist_encoder: {dist_encoder};',
-                  f'model: {trainer.model_name};')
-
-            # logging parameters and metrics
-            trainer.mlflow_log_param('model', trainer.model_name)
-            trainer.mlflow_log_param('params', trainer.model_params)
-            trainer.mlflow_log_param('dist_encoder', dist_encoder)
-            trainer.mlflow_log_metric('rmse', rmse)
-
-        # joblib
-        # trainer.save_model()
+    # every model x dist_encoder pair is fitted in parallel on features
+    # computed once; SVR can be very slow on large data, hence the timeout
+    results = run_sweep(X_train, y_train, X_val, y_val,
+                        model_list, dist_encoder_list, timeout=600)
+    print(results.to_string())
+
+    # logging parameters and metrics
+    mlflow_online = False
+    logger = get_logger(tracking_uri(mlflow_online))
+    for _, row in results[results.status == 'ok'].iterrows():
+        run = logger.start_run(EXPERIMENT_NAME)
+        run.log_param('model', row.model)
+        run.log_param('params', row.params)
+        run.log_param('dist_encoder', row.dist_encoder)
+        run.log_metric('rmse', row.rmse)
 
+    # params and metrics are sent in the background, wait for them
+    logger.flush()
     # getting location of mlflow
-    if trainer.mlflow_online:
-        experiment_id = trainer.mlflow_experiment_id
+    if mlflow_online:
+        experiment_id = logger.experiment_id(EXPERIMENT_NAME)
         print(f"experiment URL: https://mlflow.lewagon.ai/#/experiments/{experiment_id}")
@@ -1,4 +1,12 @@
+import functools
+import math
+from datetime import datetime
+
 import numpy as np
+import pandas as pd
+import pytz
+
+EARTH_RADIUS = 6371
 
 
 def haversine_vectorized(df,
@@ -12,19 +20,299 @@ def haversine_vectorized(df,
         Vectorized version of the haversine distance for pandas df
         Computes distance in kms
     """
+    return pd.Series(haversine_arrays(df[start_lat].to_numpy(),
+                                      df[start_lon].to_numpy(),
+                                      df[end_lat].to_numpy(),
+                                      df[end_lon].to_numpy()),
+                     index=df.index)
+
+
+def haversine_arrays(start_lat, start_lon, end_lat, end_lon, dtype=np.float64,
+                     out=None):
+    """
+        Haversine distance in kms between arrays (or scalars, which are
+        broadcast) of coordinates in decimal degrees, computed in dtype
+        (float64 or float32) and written to out if given
+    """
+    start_lat, start_lon, end_lat, end_lon = [
+        np.radians(np.asarray(values, dtype=dtype))
+        for values in (start_lat, start_lon, end_lat, end_lon)]
+    out = haversine_kernel(start_lat, start_lon, end_lat, end_lon,
+                           np.cos(start_lat), np.cos(end_lat), out=out)
+    # scalars in, scalar out
+    return out if out.ndim else out[()]
+
+
+def haversine_kernel(lat_1_rad, lon_1_rad, lat_2_rad, lon_2_rad,
+                     cos_lat_1, cos_lat_2, out=None):
+    """
+        Haversine distance in kms from coordinates already in radians and
+        the cosines of both latitudes, so callers computing several distances
+        from the same points only take each cosine once. Any argument can be
+        a scalar, e.g. a fixed point. Works in place in out apart from one
+        temporary array.
+    """
+    if out is None:
+        shape = np.broadcast(lat_1_rad, lon_1_rad, lat_2_rad, lon_2_rad).shape
+        out = np.empty(shape, dtype=np.result_type(lat_1_rad, lat_2_rad))
+    # out = sin(dlat / 2) ** 2
+    np.subtract(lat_2_rad, lat_1_rad, out=out)
+    out *= 0.5
+    np.sin(out, out=out)
+    np.square(out, out=out)
+    # + cos(lat_1) * cos(lat_2) * sin(dlon / 2) ** 2
+    a = np.empty_like(out)
+    np.subtract(lon_2_rad, lon_1_rad, out=a)
+    a *= 0.5
+    np.sin(a, out=a)
+    np.square(a, out=a)
+    a *= cos_lat_1
+    a *= cos_lat_2
+    out += a
+    np.sqrt(out, out=out)
+    np.arcsin(out, out=out)
+    out *= 2 * EARTH_RADIUS
+    return out
+
+
+DISTANCE_FEATURES = ('distance', 'pickup_distance_to_center',
+                     'dropoff_distance_to_center')
+
 
-    lat_1_rad, lon_1_rad = np.radians(df[start_lat].astype(float)),\
-        np.radians(df[start_lon].astype(float))
-    lat_2_rad, lon_2_rad = np.radians(df[end_lat].astype(float)),\
-        np.radians(df[end_lon].astype(float))
+def distance_features(start_lat, start_lon, end_lat, end_lon, center,
+                      columns=DISTANCE_FEATURES, dtype=np.float64, out=None,
+                      block_size=65_536):
+    """
+        Computes the distance features of DISTANCE_FEATURES named in columns
+        in a single pass, block by block: each block of coordinates is
+        converted to radians in dtype once and the cosines of its latitudes
+        are shared by the three distances, so the temporaries stay small
+        whatever the number of rows. center is a (lat, lon) tuple.
+        Returns an array of shape (n_rows, len(columns)), written to out if
+        given.
+    """
+    indices = [DISTANCE_FEATURES.index(column) for column in columns]
+    n_rows = len(start_lat)
+    if out is None:
+        out = np.empty((n_rows, len(columns)), dtype=dtype)
+    center_lat, center_lon = np.radians(center, dtype=dtype)
+    cos_center = np.cos(center_lat)
+    buffer = np.empty(min(block_size, n_rows), dtype=dtype)
+
+    def radians(values, start, stop):
+        # converting block by block avoids a full float64 copy of float32
+        # or object columns
+        return np.radians(np.asarray(values[start:stop], dtype=dtype))
+
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        lat_1, lon_1 = radians(start_lat, start, stop), radians(start_lon, start, stop)
+        lat_2, lon_2 = radians(end_lat, start, stop), radians(end_lon, start, stop)
+        cos_1, cos_2 = np.cos(lat_1), np.cos(lat_2)
+        block = buffer[:stop - start]
+        for j, index in enumerate(indices):
+            if index == 0:
+                haversine_kernel(lat_1, lon_1, lat_2, lon_2, cos_1, cos_2,
+                                 out=block)
+            elif index == 1:
+                haversine_kernel(center_lat, center_lon, lat_1, lon_1,
+                                 cos_center, cos_1, out=block)
+            else:
+                haversine_kernel(center_lat, center_lon, lat_2, lon_2,
+                                 cos_center, cos_2, out=block)
+            out[start:stop, j] = block
+    return out
+
+
+def haversine(start_lat, start_lon, end_lat, end_lon):
+    """
+        Scalar version of haversine_vectorized for a single pair of points,
+        computes distance in kms
+    """
+    lat_1_rad, lon_1_rad = math.radians(start_lat), math.radians(start_lon)
+    lat_2_rad, lon_2_rad = math.radians(end_lat), math.radians(end_lon)
     dlon = lon_2_rad - lon_1_rad
     dlat = lat_2_rad - lat_1_rad
 
-    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat_1_rad) * np.cos(lat_2_rad) *\
-        np.sin(dlon / 2.0) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    return 6371 * c
+    a = math.sin(dlat / 2.0) ** 2 + math.cos(lat_1_rad) * math.cos(lat_2_rad) *\
+        math.sin(dlon / 2.0) ** 2
+    c = 2 * math.asin(math.sqrt(a))
+    return EARTH_RADIUS * c
 
 
 def compute_rmse(y_pred, y_true):
     return np.sqrt(((y_pred - y_true) ** 2).mean())
+
+
+# "2013-07-06 17:18:00 UTC": positions of the digits and separators
+UTC_FORMAT_LENGTH = 23
+UTC_FORMAT_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+UTC_FORMAT_SEPARATORS = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':',
+                         19: b' ', 20: b'U', 21: b'T', 22: b'C'}
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 of proleptic Gregorian dates, vectorized"""
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 \
+        + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 \
+        + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def civil_from_days(days):
+    """Inverse of days_from_civil, returns (year, month, day) arrays"""
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524
+                   - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4
+                                - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = np.where(month_index < 10, month_index + 3, month_index - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year, month, day
+
+
+def parse_utc_seconds(values):
+    """
+        Parses strings formatted as "%Y-%m-%d %H:%M:%S UTC" into int64 epoch
+        seconds without format inference. Datetime inputs are converted
+        directly. Returns None if any value is missing, does not match the
+        format or is out of range (e.g. month 13), the callers then let
+        pandas parse or reject the values.
+    """
+    values = pd.Series(values)
+    if values.isna().any():
+        return None
+    if pd.api.types.is_datetime64_any_dtype(values):
+        if values.dt.tz is not None:
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        return values.to_numpy(dtype='datetime64[s]').astype('int64')
+
+    try:
+        raw = np.asarray(values.to_numpy(), dtype=f'S{UTC_FORMAT_LENGTH + 1}')
+    except (UnicodeEncodeError, ValueError, TypeError):
+        return None
+    chars = raw.view('uint8').reshape(len(raw), UTC_FORMAT_LENGTH + 1)
+    if (chars[:, UTC_FORMAT_LENGTH] != 0).any():
+        return None
+    for position, separator in UTC_FORMAT_SEPARATORS.items():
+        if (chars[:, position] != ord(separator)).any():
+            return None
+    digits = chars[:, UTC_FORMAT_DIGITS].astype('int64') - ord('0')
+    if ((digits < 0) | (digits > 9)).any():
+        return None
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 \
+        + digits[:, 3]
+    month, day, hour, minute, second = (
+        digits[:, i] * 10 + digits[:, i + 1] for i in range(4, 14, 2))
+    if ((month < 1) | (month > 12)).any():
+        return None
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = DAYS_IN_MONTH[month - 1] + ((month == 2) & leap)
+    if ((day < 1) | (day > month_days) | (hour > 23) | (minute > 59)
+            | (second > 59)).any():
+        return None
+    return days_from_civil(year, month, day) * 86400 \
+        + hour * 3600 + minute * 60 + second
+
+
+@functools.lru_cache(maxsize=None)
+def utc_offset_table(time_zone_name):
+    """
+        Returns the sorted UTC transition times (epoch seconds) of a time
+        zone and the UTC offset in seconds in effect from each of them
+    """
+    time_zone = pytz.timezone(time_zone_name)
+    if not hasattr(time_zone, '_utc_transition_times'):
+        offset = time_zone.utcoffset(datetime(1970, 1, 1))
+        return np.array([np.iinfo('int64').min]), \
+            np.array([int(offset.total_seconds())])
+    epoch = datetime(1970, 1, 1)
+    times = np.array([int((transition - epoch).total_seconds())
+                      for transition in time_zone._utc_transition_times])
+    times[0] = np.iinfo('int64').min
+    offsets = np.array([int(info[0].total_seconds())
+                        for info in time_zone._transition_info])
+    return times, offsets
+
+
+def local_time_features(utc_seconds, time_zone_name, out=None):
+    """
+        Computes the local day of week (Monday=0), hour, month and year of
+        epoch seconds in a time zone, as the columns of an (n, 4) int64 array
+    """
+    times, offsets = utc_offset_table(time_zone_name)
+    local = utc_seconds + offsets[np.searchsorted(times, utc_seconds,
+                                                  side='right') - 1]
+    days = local // 86400
+    if out is None:
+        out = np.empty((len(local), 4), dtype='int64')
+    year, month, _ = civil_from_days(days)
+    out[:, 0] = (days + 3) % 7  # 1970-01-01 was a Thursday
+    out[:, 1] = (local - days * 86400) // 3600
+    out[:, 2] = month
+    out[:, 3] = year
+    return out
+
+
+class ErrorAccumulator():
+    """
+        Running sums of squared and absolute errors, overall, per hour and per
+        distance bucket, so RMSE and MAE can be computed over a stream of
+        chunks in constant memory. Accumulators of different chunks can be
+        merged, which allows scoring chunks in parallel.
+        distance_edges: inner edges of the distance buckets, e.g. deciles
+    """
+
+    def __init__(self, distance_edges):
+        self.distance_edges = np.asarray(distance_edges, dtype=float)
+        n_distance = len(self.distance_edges) + 1
+        self.sums = dict(total=np.zeros((3, 1)),
+                         hour=np.zeros((3, 24)),
+                         distance=np.zeros((3, n_distance)))
+
+    def update(self, y_pred, y_true, hour, distance):
+        errors = np.asarray(y_pred, dtype=float) - np.asarray(y_true, dtype=float)
+        buckets = dict(total=np.zeros(len(errors), dtype='int64'),
+                       hour=np.asarray(hour, dtype='int64'),
+                       distance=np.searchsorted(self.distance_edges, distance,
+                                                side='right'))
+        for name, bucket in buckets.items():
+            size = self.sums[name].shape[1]
+            self.sums[name] += [np.bincount(bucket, minlength=size),
+                                np.bincount(bucket, errors * errors, minlength=size),
+                                np.bincount(bucket, np.abs(errors), minlength=size)]
+        return self
+
+    def merge(self, other):
+        for name in self.sums:
+            self.sums[name] += other.sums[name]
+        return self
+
+    @staticmethod
+    def _metrics(count, sum_squares, sum_abs):
+        if count == 0:
+            return dict(count=0, rmse=None, mae=None)
+        return dict(count=int(count), rmse=float(np.sqrt(sum_squares / count)),
+                    mae=float(sum_abs / count))
+
+    def results(self):
+        results = self._metrics(*self.sums['total'][:, 0])
+        results['by_hour'] = [self._metrics(*column)
+                              for column in self.sums['hour'].T]
+        results['by_distance'] = [
+            dict(low=float(low), high=float(high), **self._metrics(*column))
+            for low, high, column in zip(
+                np.r_[-np.inf, self.distance_edges],
+                np.r_[self.distance_edges, np.inf],
+                self.sums['distance'].T)]
+        return results
@@ -0,0 +1,22 @@
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+from taxifare.benchmarks import make_trips
+from taxifare.data import clean_df
+from taxifare.trainer import Trainer
+
+
+@pytest.fixture(scope='session')
+def trips():
+    df = clean_df(make_trips(2000, seed=0))
+    return df.drop(columns='fare_amount'), df['fare_amount']
+
+
+@pytest.fixture(scope='session')
+def pipeline(trips):
+    X, y = trips
+    trainer = Trainer(X, y, model=RandomForestRegressor(n_estimators=5,
+                                                        max_depth=6,
+                                                        random_state=0))
+    trainer.run()
+    return trainer.pipeline
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from taxifare.artifacts import (ARTIFACT_FORMATS, FlatForestRegressor,
+                                load_artifact, save_artifact)
+
+
+@pytest.mark.parametrize('artifact', ARTIFACT_FORMATS)
+def test_artifacts_predict_like_the_original(tmp_path, trips, pipeline,
+                                             artifact):
+    X, _ = trips
+    path = save_artifact(pipeline, str(tmp_path / f'{artifact}.joblib'), artifact)
+    loaded = load_artifact(path)
+    # flat artifacts compare float32 thresholds and average float32 leaves
+    tolerance = 1e-4 if artifact == 'flat' else 0
+    np.testing.assert_allclose(loaded.predict(X), pipeline.predict(X),
+                               rtol=0, atol=tolerance)
+
+
+def test_flat_artifact_is_memory_mapped(tmp_path, pipeline):
+    path = save_artifact(pipeline, str(tmp_path / 'flat.joblib'), 'flat')
+    model = load_artifact(path, mmap_mode='r').steps[-1][1]
+    assert isinstance(model, FlatForestRegressor)
+    assert isinstance(model.threshold, np.memmap)
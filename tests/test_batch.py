@@ -0,0 +1,29 @@
+from app.batch import build_batch, parse_trip
+
+TRIP = dict(pickup_datetime='2013-07-06 17:18:00',
+            pickup_longitude=-73.950655,
+            pickup_latitude=40.783282,
+            dropoff_longitude=-73.984365,
+            dropoff_latitude=40.769802,
+            passenger_count=1)
+
+
+def test_non_finite_values_are_rejected_per_row():
+    trips = [TRIP, dict(TRIP, pickup_latitude='inf'),
+             dict(TRIP, dropoff_longitude='1e400'),
+             dict(TRIP, passenger_count='-inf')]
+    X_pred, valid, errors = build_batch(trips)
+    assert valid.tolist() == [True, False, False, False]
+    assert len(X_pred) == 1
+    assert errors[1] == 'invalid value for: pickup_latitude'
+    assert errors[2] == 'invalid value for: dropoff_longitude'
+    assert errors[3] == 'invalid value for: passenger_count'
+
+
+def test_parse_trip_matches_build_batch():
+    for trip in [TRIP, dict(TRIP, pickup_latitude='inf'),
+                 dict(TRIP, dropoff_latitude='1e400'),
+                 dict(TRIP, passenger_count=1.5),
+                 dict(TRIP, pickup_datetime='2013-03-10 02:30:00')]:
+        _, error = parse_trip(trip)
+        assert error == build_batch([trip])[2][0]
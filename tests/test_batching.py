@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+from app.batching import MicroBatcher
+
+
+def double(rows):
+    if 'bad' in rows:
+        raise ValueError('bad row')
+    return [row * 2 for row in rows]
+
+
+def test_failing_row_only_fails_its_request():
+    async def submit_all():
+        batcher = MicroBatcher(double, max_wait_ms=20)
+        batcher.start()
+        results = await asyncio.gather(
+            *[batcher.submit(row) for row in ['a', 'bad', 'c']],
+            return_exceptions=True)
+        await batcher.stop()
+        return batcher, results
+
+    batcher, results = asyncio.run(submit_all())
+    assert batcher.n_batches == 1
+    assert results[0] == 'aa' and results[2] == 'cc'
+    assert isinstance(results[1], ValueError)
+
+
+def test_stop_answers_pending_requests():
+    def slow_double(rows):
+        time.sleep(0.1)
+        return double(rows)
+
+    async def stop_while_busy():
+        batcher = MicroBatcher(slow_double, max_wait_ms=1, max_batch_size=2)
+        batcher.start()
+        requests = [asyncio.ensure_future(batcher.submit(row))
+                    for row in 'abcde']
+        # the first batch is running and the other rows are queued
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*requests), 1)
+
+    assert asyncio.run(stop_while_busy()) == ['aa', 'bb', 'cc', 'dd', 'ee']
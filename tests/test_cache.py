@@ -0,0 +1,60 @@
+from app import cache as cache_module
+from app.cache import PredictionCache, trip_key
+
+TRIP = dict(pickup_datetime='2013-07-06 17:18:00',
+            pickup_longitude=-73.950655, pickup_latitude=40.783282,
+            dropoff_longitude=-73.984365, dropoff_latitude=40.769802,
+            passenger_count=1)
+
+
+def test_trip_key_quantizes_time_and_coordinates():
+    nearby = dict(TRIP, pickup_datetime='2013-07-06 17:59:59',
+                  pickup_longitude=-73.95068)
+    assert trip_key(nearby) == trip_key(TRIP)
+    assert trip_key(dict(TRIP, pickup_datetime='2013-07-06 18:00:00')) != \
+        trip_key(TRIP)
+    assert trip_key(dict(TRIP, pickup_latitude='nan')) is None
+    assert trip_key(dict(TRIP, pickup_datetime='tomorrow')) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PredictionCache(capacity=2)
+    # the first lookup binds the cache to the model version
+    cache.get('a', 'v1')
+    cache.put('a', 'v1', 'a')
+    cache.put('b', 'v1', 'b')
+    assert cache.get('a', 'v1') == 'a'
+    cache.put('c', 'v1', 'c')
+    assert cache.get('b', 'v1') is None
+    assert cache.get('a', 'v1') == 'a' and cache.get('c', 'v1') == 'c'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+    cache = PredictionCache(ttl=10)
+    cache.get('a', 'v1')
+    cache.put('a', 'v1', {'fare': 9.5})
+    now[0] += 9
+    assert cache.get('a', 'v1') == {'fare': 9.5}
+    now[0] += 2
+    assert cache.get('a', 'v1') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_new_model_version_invalidates_entries():
+    cache = PredictionCache()
+    cache.get('a', 'v1')
+    cache.put('a', 'v1', {'fare': 9.5})
+    assert cache.get('a', 'v2') is None
+    assert cache.stats()['invalidations'] == 1
+    # a result of the replaced model is not stored
+    cache.put('a', 'v1', {'fare': 9.5})
+    assert cache.get('a', 'v2') is None and cache.stats()['size'] == 0
+
+
+def test_zero_capacity_disables_the_cache():
+    cache = PredictionCache(capacity=0)
+    cache.put('a', None, {'fare': 9.5})
+    assert cache.get('a', None) is None and cache.stats()['misses'] == 0
@@ -0,0 +1,12 @@
+import numpy as np
+
+from taxifare.compiled import CompiledPipeline, check_parity
+
+
+def test_compiled_predict_matches_pipeline(trips, pipeline):
+    X, _ = trips
+    compiled = CompiledPipeline(pipeline)
+    expected = pipeline.predict(X)
+    np.testing.assert_allclose(compiled.predict(X.to_dict('records')), expected,
+                               atol=1e-9)
+    assert check_parity(pipeline, X.head(200), compiled) < 1e-9
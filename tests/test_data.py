@@ -0,0 +1,107 @@
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from taxifare.benchmarks import clean_df_sequential, make_trips
+from taxifare.data import (build_cache, clean_df, get_data, read_cache,
+                           sample_data, sample_rows)
+
+
+def test_concurrent_cache_builds(tmp_path):
+    path = str(tmp_path / 'train.csv')
+    make_trips(500).to_csv(path, index=False)
+    cache_dir = str(tmp_path / 'cache')
+    with ThreadPoolExecutor(4) as executor:
+        targets = set(executor.map(lambda _: build_cache(path, cache_dir=cache_dir),
+                                   range(4)))
+    assert len(targets) == 1
+    assert os.listdir(cache_dir) == [os.path.basename(targets.pop())]
+    assert len(read_cache(path=path, cache_dir=cache_dir)) == \
+        len(clean_df(make_trips(500)))
+
+
+def test_iter_data_streams_cleaned_compact_chunks(tmp_path):
+    path = str(tmp_path / 'train.csv')
+    df = make_trips(1000, invalid_fraction=0.1)
+    df.to_csv(path, index=False)
+    stats = Counter()
+    chunks = list(get_data(nrows=900, chunksize=256, path=path, stats=stats))
+    assert len(chunks) == 4 and all(len(chunk) <= 256 for chunk in chunks)
+
+    streamed = pd.concat(chunks)
+    expected = clean_df(df.head(900))
+    assert stats['rows_read'] == 900
+    assert stats['rows_kept'] == len(streamed) == len(expected)
+    assert streamed['pickup_latitude'].dtype == np.float32
+    assert streamed['passenger_count'].dtype == np.uint8
+    assert str(streamed['pickup_datetime'].dt.tz) == 'UTC'
+    np.testing.assert_array_equal(streamed['key'], expected['key'])
+    np.testing.assert_allclose(streamed['pickup_longitude'],
+                               expected['pickup_longitude'], rtol=1e-6)
+    pd.testing.assert_series_equal(
+        streamed['pickup_datetime'],
+        pd.to_datetime(expected['pickup_datetime'], utc=True), check_index=False)
+
+
+def test_clean_df_matches_sequential_filters():
+    df = make_trips(2000, seed=3, invalid_fraction=0.05)
+    rng = np.random.default_rng(3)
+    rows = rng.choice(len(df), 60, replace=False).reshape(6, 10)
+    df.loc[rows[0], 'fare_amount'] = 0
+    df.loc[rows[1], 'passenger_count'] = rng.choice([0, 9], 10)
+    df.loc[rows[2], 'dropoff_longitude'] = -74.2
+    df.loc[rows[3], ['dropoff_latitude', 'dropoff_longitude']] = 0
+    df.loc[rows[4], 'dropoff_latitude'] = df.loc[rows[4], 'pickup_latitude']
+    df.loc[rows[5], 'pickup_datetime'] = None
+
+    stats = Counter()
+    cleaned = clean_df(df, stats=stats)
+    pd.testing.assert_frame_equal(cleaned, clean_df_sequential(df))
+    assert stats['rows_read'] == len(df) and stats['rows_kept'] == len(cleaned)
+    assert stats['fare_amount'] == stats['passenger_count'] == 10
+    assert stats['missing_values'] == stats['dropoff_zero'] == 10
+    assert stats['same_location'] >= 10
+    # a row failing several rules is counted by each of them
+    assert stats['dropoff_longitude'] == 20
+
+
+def test_sampling_is_reproducible(tmp_path):
+    path = str(tmp_path / 'train.csv')
+    df = make_trips(3000)
+    df.to_csv(path, index=False)
+    sample = sample_data(200, seed=1, path=path, chunksize=1000)
+    pd.testing.assert_frame_equal(sample, sample_data(200, seed=1, path=path,
+                                                      chunksize=1000))
+    pd.testing.assert_frame_equal(sample, get_data(200, sample='reservoir',
+                                                   seed=1, path=path))
+    assert not sample['key'].equals(sample_data(200, seed=2, path=path)['key'])
+    # distinct rows of the file, in file order
+    positions = df.reset_index().set_index('key').loc[sample['key'], 'index']
+    assert positions.is_monotonic_increasing and positions.is_unique
+
+    cache_dir = str(tmp_path / 'cache')
+    rows = sample_rows(200, seed=1, path=path, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(rows, sample_rows(200, seed=1, path=path,
+                                                    cache_dir=cache_dir))
+    positions = df.reset_index().set_index('key').loc[rows['key'], 'index']
+    assert positions.is_monotonic_increasing and positions.is_unique
+    np.testing.assert_allclose(rows['fare_amount'], df['fare_amount'][positions],
+                               rtol=1e-6)
+
+
+def test_stratified_sample_respects_the_strata(tmp_path):
+    path = str(tmp_path / 'train.csv')
+    df = make_trips(3000)
+    # three local hours holding 60%, 30% and 10% of the rows
+    df['pickup_datetime'] = np.repeat(['2014-03-03 13:10:00 UTC',
+                                       '2014-03-03 18:20:00 UTC',
+                                       '2015-01-05 02:30:00 UTC'],
+                                      [1800, 900, 300])
+    df.sample(frac=1, random_state=0).to_csv(path, index=False)
+    for seed in range(3):
+        sample = sample_data(100, method='stratified', seed=seed, path=path,
+                             chunksize=500)
+        assert sample['pickup_datetime'].value_counts().tolist() == [60, 30, 10]
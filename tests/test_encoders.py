@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import Ridge
+
+from taxifare.encoders import DistanceToCenter, DistanceTransformer, TimeFeaturesEncoder
+from taxifare.trainer import Trainer
+
+
+@pytest.mark.parametrize('encoder', [TimeFeaturesEncoder(), DistanceTransformer(),
+                                     DistanceToCenter()])
+def test_encoders_leave_X_untouched(trips, encoder):
+    X, _ = trips
+    X = X.iloc[::2]
+    before = X.copy()
+    features = encoder.fit_transform(X)
+    pd.testing.assert_frame_equal(X, before)
+    assert features.index.equals(X.index)
+    assert not set(features.columns) & set(X.columns)
+
+
+def test_parallel_feature_blocks_match_serial(trips):
+    X, y = trips
+    predictions = []
+    for n_jobs in (None, 2):
+        trainer = Trainer(X, y, model=Ridge(), n_jobs=n_jobs)
+        trainer.run()
+        predictions.append(trainer.pipeline.predict(X))
+    np.testing.assert_allclose(predictions[0], predictions[1])
@@ -0,0 +1,29 @@
+import numpy as np
+
+from taxifare.benchmarks import make_trips
+from taxifare.data import read_cache
+from taxifare.features import FeatureStore
+from taxifare.sweep import compute_features
+
+
+def test_store_matches_compute_features(tmp_path):
+    sources = []
+    for i, n_rows in enumerate([300, 200]):
+        path = tmp_path / f'part{i}.csv'
+        make_trips(n_rows, seed=i).to_csv(path, index=False)
+        sources.append(path)
+    store = FeatureStore(str(tmp_path / 'features'),
+                         cache_dir=str(tmp_path / 'cache'), n_jobs=1,
+                         rows_per_job=128)
+    for path in sources:
+        store.append(str(path))
+    assert store.stale() == []
+
+    X, y = store.load()
+    expected = [store.read_block('fare_amount', [name])[0]
+                for name in ('part0', 'part1')]
+    np.testing.assert_array_equal(y, np.concatenate(expected))
+    cleaned = [read_cache(path=str(path), cache_dir=str(tmp_path / 'cache'))
+               for path in sources]
+    np.testing.assert_allclose(
+        X, np.vstack([compute_features(df) for df in cleaned]))
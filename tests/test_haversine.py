@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from taxifare.benchmarks import (distance_features_reference, haversine_reference,
+                                 make_coordinates)
+from taxifare.encoders import NYC_CENTER
+from taxifare.utils import (distance_features, haversine, haversine_arrays,
+                            haversine_kernel, haversine_vectorized)
+
+COLUMNS = ['pickup_latitude', 'pickup_longitude',
+           'dropoff_latitude', 'dropoff_longitude']
+
+
+@pytest.fixture(scope='module')
+def coordinates():
+    return make_coordinates(10_000, seed=1)
+
+
+def test_kernel_matches_haversine_vectorized(coordinates):
+    lat_1, lon_1, lat_2, lon_2 = [np.radians(coordinates[column].to_numpy(float))
+                                  for column in COLUMNS]
+    out = np.empty(len(coordinates))
+    result = haversine_kernel(lat_1, lon_1, lat_2, lon_2,
+                              np.cos(lat_1), np.cos(lat_2), out=out)
+    assert result is out
+    expected = haversine_vectorized(coordinates)
+    np.testing.assert_allclose(out, expected, rtol=1e-12)
+    np.testing.assert_allclose(expected, haversine_reference(coordinates, *COLUMNS),
+                               rtol=1e-12)
+    row = coordinates.iloc[0]
+    assert haversine(*row[COLUMNS]) == pytest.approx(expected.iloc[0], rel=1e-12)
+
+
+def test_float32_distances(coordinates):
+    arrays = [coordinates[column].to_numpy() for column in COLUMNS]
+    distances = haversine_arrays(*arrays, dtype=np.float32)
+    assert distances.dtype == np.float32
+    # within a meter on distances of a few km
+    np.testing.assert_allclose(distances, haversine_arrays(*arrays), atol=1e-3)
+
+
+def test_distance_features_match_reference_block_by_block(coordinates):
+    arrays = [coordinates[column].to_numpy() for column in COLUMNS]
+    out = np.zeros((len(coordinates), 3))
+    distance_features(*arrays, NYC_CENTER, out=out, block_size=999)
+    np.testing.assert_allclose(out, distance_features_reference(coordinates),
+                               rtol=1e-12)
+    np.testing.assert_array_equal(
+        distance_features(*arrays, NYC_CENTER, columns=['dropoff_distance_to_center']),
+        out[:, 2:])
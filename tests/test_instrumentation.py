@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from taxifare import instrumentation
+from taxifare.benchmarks import make_trips
+from taxifare.data import clean_df
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.reset()
+    instrumentation.enable()
+    yield
+    instrumentation.disable()
+    instrumentation.reset()
+
+
+def test_disabled_timers_record_nothing():
+    instrumentation.reset()
+    assert instrumentation.timed('stage') is instrumentation.NULL_TIMER
+    clean_df(make_trips(100))
+    assert instrumentation.prometheus_text().count('stage=') == 0
+
+
+def test_instrumented_pipeline_records_each_stage(enabled, trips, pipeline):
+    X, _ = trips
+    instrumented = instrumentation.instrument_pipeline(pipeline)
+    np.testing.assert_array_equal(instrumented.predict(X), pipeline.predict(X))
+    # the original pipeline is not wrapped
+    assert not any(isinstance(step, instrumentation.Timed)
+                   for _, step in pipeline.steps)
+    stripped = instrumentation.strip_instrumentation(instrumented)
+    np.testing.assert_array_equal(stripped.predict(X), pipeline.predict(X))
+
+    # only the instrumented copy recorded its stages
+    text = instrumentation.prometheus_text()
+    for stage in ('dist.transform', 'dist_to_center.transform',
+                  'time.transform', 'model.predict'):
+        assert f'taxifare_stage_seconds_count{{stage="{stage}"}} 1' in text
+        assert f'taxifare_stage_rows_total{{stage="{stage}"}} {len(X)}' in text
+
+
+def test_timed_function_counts_result_rows(enabled):
+    df = make_trips(500)
+    kept = len(clean_df(df))
+    metrics = instrumentation._metrics['data.clean_df']
+    assert metrics.count == 1 and metrics.rows == kept
+    assert metrics.quantile(0.5) >= metrics.seconds
+    assert 'data.clean_df' in instrumentation.report()
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+import numpy as np
+
+from app.lookup import LookupTier
+from taxifare.lookup import build_table, report_trips
+
+
+def test_table_matches_model_at_cell_centers(tmp_path, trips, pipeline):
+    path = str(tmp_path / 'lookup.json')
+    table = build_table(pipeline, 2015, 6, path, resolution=0.1,
+                        model_version='v1', n_jobs=1)
+    assert table.values.dtype == np.float32
+    X, _ = trips
+    X = report_trips(X.head(200), 2015, 6)
+    # move the trips to the centers of their cells
+    for end in ('pickup', 'dropoff'):
+        for axis, low in (('latitude', table.lat_min),
+                          ('longitude', table.lon_min)):
+            column = f'{end}_{axis}'
+            X[column] = low + (np.floor((X[column] - low) / 0.1) + 0.5) * 0.1
+    # the weekday bucket of June 2015 is evaluated on monday the 1st at
+    # 14:30 local time for the 12h-16h bucket
+    X['pickup_datetime'] = '2015-06-08 18:30:00 UTC'
+    np.testing.assert_allclose(table.lookup_many(X), pipeline.predict(X),
+                               rtol=1e-6)
+
+
+def test_rebuild_replaces_values_and_manifest_together(tmp_path, pipeline):
+    path = str(tmp_path / 'lookup.json')
+    build_table(pipeline, 2015, 6, path, resolution=0.2, model_version='v1',
+                n_jobs=1)
+    tier = LookupTier(path, poll_interval=0)
+    trip = dict(pickup_datetime='2015-06-03 17:18:00',
+                pickup_longitude=-73.95, pickup_latitude=40.78,
+                dropoff_longitude=-73.98, dropoff_latitude=40.77,
+                passenger_count=1)
+    assert tier.get(trip, 'v1') is not None
+    assert tier.get(trip, 'v2') is None
+
+    build_table(pipeline, 2015, 6, path, resolution=0.1, model_version='v2',
+                n_jobs=1)
+    assert tier.get(trip, 'v2') is not None
+    assert tier.table.resolution == 0.1
+    assert len([name for name in os.listdir(tmp_path)
+                if name.endswith('.npy')]) == 1
+
+
+def test_trips_of_any_month_are_looked_up_by_day_group_and_hour(tmp_path, trips,
+                                                                pipeline):
+    table = build_table(pipeline, 2015, 6, str(tmp_path / 'lookup.json'),
+                        resolution=0.1, n_jobs=1)
+    X, _ = trips
+    X = report_trips(X.head(100), 2015, 6)
+    # mondays around 18:30 UTC, in and out of the reference month
+    X['pickup_datetime'] = '2015-06-08 18:30:00 UTC'
+    reference = table.lookup_many(X)
+    assert not np.isnan(reference).all()
+    for pickup_datetime in ('2013-01-07 19:30:00 UTC', '2016-11-14 19:30:00 UTC'):
+        X['pickup_datetime'] = pickup_datetime
+        np.testing.assert_array_equal(table.lookup_many(X), reference)
+
+
+def test_tier_reloads_on_a_new_build_not_on_a_copy(tmp_path, pipeline):
+    path = str(tmp_path / 'lookup.json')
+    build_table(pipeline, 2015, 6, path, resolution=0.2, model_version='v1',
+                n_jobs=1)
+    tier = LookupTier(path, poll_interval=0)
+    table = tier.current('v1')
+    assert table is not None
+
+    # copying the table elsewhere and back changes its mtime, not its build
+    copy = tmp_path / 'copy'
+    shutil.copytree(tmp_path, copy, ignore=shutil.ignore_patterns('copy'))
+    for name in os.listdir(copy):
+        shutil.copy(copy / name, tmp_path / name)
+    assert tier.current('v1') is table
+
+    build_table(pipeline, 2015, 6, path, resolution=0.1, model_version='v1',
+                n_jobs=1)
+    assert tier.current('v1') is not table
+    assert tier.current('v1').resolution == 0.1
@@ -0,0 +1,23 @@
+import joblib
+import numpy as np
+
+from app.registry import ModelRegistry
+
+
+def test_overwriting_the_model_file_keeps_the_loaded_model(tmp_path, trips,
+                                                            pipeline):
+    X, _ = trips
+    path = tmp_path / 'model.joblib'
+    joblib.dump(pipeline, path)
+    registry = ModelRegistry(str(path), poll_interval=0)
+    loaded = registry.get()
+    expected = loaded.model.predict(X)
+
+    # truncates and rewrites the same inode
+    with open(path, 'r+b') as f:
+        f.truncate(0)
+    np.testing.assert_array_equal(loaded.model.predict(X), expected)
+
+    joblib.dump(pipeline, path)
+    registry.load()
+    assert len(list((tmp_path / '.snapshots').iterdir())) == 1
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.linear_model import Lasso, Ridge
+from sklearn.model_selection import train_test_split
+
+from taxifare.sweep import run_sweep, successive_halving
+from taxifare.trainer import Trainer
+
+
+class FailingRegressor(BaseEstimator, RegressorMixin):
+    def fit(self, X, y):
+        raise RuntimeError('cannot fit')
+
+
+@pytest.fixture(scope='module')
+def split(trips):
+    X, y = trips
+    return train_test_split(X, y, test_size=0.2, random_state=0)
+
+
+def test_sweep_matches_trainer(split, tmp_path):
+    X_train, X_val, y_train, y_val = split
+    results = run_sweep(X_train, y_train, X_val, y_val,
+                        [Ridge(), Lasso(alpha=0.05), FailingRegressor()],
+                        n_jobs=2, cache_dir=str(tmp_path))
+    assert len(results) == 9
+    ok = results[results.status == 'ok']
+    assert len(ok) == 6 and ok.rmse.is_monotonic_increasing
+    assert results.status.str.startswith('error').sum() == 3
+    # the features were cached once for every job
+    assert len(list(tmp_path.iterdir())) == 1
+
+    for dist_encoder in ('dist', 'both'):
+        trainer = Trainer(X_train, y_train, model=Ridge(),
+                          dist_encoder=dist_encoder)
+        trainer.run()
+        rmse = ok[(ok.model == 'ridge') &
+                  (ok.dist_encoder == dist_encoder)].rmse.item()
+        assert rmse == pytest.approx(trainer.evaluate(X_val, y_val))
+
+
+class SlowRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, delay=30.0):
+        self.delay = delay
+
+    def fit(self, X, y):
+        time.sleep(self.delay)
+        return self
+
+
+def test_successive_halving_rungs(split):
+    X_train, X_val, y_train, y_val = split
+    search_space = {'ridge': (Ridge(), {'alpha': [0.1, 1.0, 10.0]})}
+    leaderboard, best = successive_halving(
+        X_train, y_train, X_val, y_val, search_space=search_space,
+        n_candidates=9, min_rows=200, factor=3, n_jobs=2)
+    rungs = leaderboard.groupby('rung').agg(n_rows=('n_rows', 'first'),
+                                            candidates=('candidate', 'size'))
+    assert rungs.to_dict('list') == dict(n_rows=[200, 600, len(y_train)],
+                                         candidates=[9, 3, 1])
+    # each rung keeps the best third of the previous one
+    for rung in (1, 2):
+        previous = leaderboard[leaderboard.rung == rung - 1]
+        kept = set(leaderboard[leaderboard.rung == rung].candidate)
+        assert kept == set(previous.nsmallest(len(kept), 'rmse').candidate)
+    assert leaderboard.iloc[0].rung == 2
+    assert best[1] == leaderboard.iloc[0].dist_encoder
+
+
+def test_successive_halving_stops_at_the_budget(split):
+    X_train, X_val, y_train, y_val = split
+    start = time.monotonic()
+    leaderboard, best = successive_halving(
+        X_train, y_train, X_val, y_val,
+        search_space={'slow': (SlowRegressor(), {'delay': [30.0, 31.0]})},
+        n_candidates=2, min_rows=200, n_jobs=2, budget=1)
+    assert time.monotonic() - start < 10
+    assert best is None
+    assert (leaderboard.status == 'budget exceeded').all()
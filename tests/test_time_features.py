@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from taxifare.benchmarks import (dst_boundary_datetimes, make_trips,
+                                 pandas_time_features)
+from taxifare.encoders import TimeFeaturesEncoder
+from taxifare.utils import local_time_features, parse_utc_seconds
+
+
+def test_time_features_match_pandas_around_dst():
+    pickup_datetime = pd.concat([dst_boundary_datetimes(),
+                                 make_trips(10_000)['pickup_datetime']])
+    expected = pandas_time_features(pickup_datetime)
+    actual = local_time_features(parse_utc_seconds(pickup_datetime),
+                                 'America/New_York')
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('value', ['2013-13-45 25:61:00 UTC',
+                                   '2013-02-29 12:00:00 UTC',
+                                   '2013-04-31 12:00:00 UTC',
+                                   '2013-07-06 24:00:00 UTC',
+                                   '2013-07-06 17:18:60 UTC'])
+def test_out_of_range_fields_are_not_parsed(value):
+    assert parse_utc_seconds([value]) is None
+    with pytest.raises(ValueError):
+        TimeFeaturesEncoder().transform(pd.DataFrame({'pickup_datetime': [value]}))
+
+
+def test_leap_day_is_parsed():
+    assert parse_utc_seconds(['2012-02-29 23:59:59 UTC'])[0] == \
+        pd.Timestamp('2012-02-29 23:59:59', tz='UTC').value // 10 ** 9
+
+
+def test_missing_datetime_gives_nan_features():
+    features = TimeFeaturesEncoder().transform(pd.DataFrame(
+        {'pickup_datetime': ['2013-07-06 17:18:00 UTC', None]}))
+    assert features.iloc[0].tolist() == [5, 13, 7, 2013]
+    assert features.iloc[1].isna().all()
@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip('mlflow')
+
+from taxifare.tracking import AsyncMlflowLogger  # noqa: E402
+
+
+def test_logger_writes_to_a_local_file_store(tmp_path, monkeypatch):
+    # recent mlflow versions only use file stores when explicitly allowed
+    monkeypatch.setenv('MLFLOW_ALLOW_FILE_STORE', 'true')
+    logger = AsyncMlflowLogger(f'file://{tmp_path}/mlruns', flush_interval=0.05)
+    first, second = logger.start_run('test'), logger.start_run('test')
+    first.log_param('model', 'ridge')
+    first.log_metric('rmse', 4.5)
+    first.log_metric('rmse', 4.0, step=1)
+    second.log_param('model', 'lasso')
+
+    first_id, second_id = first.wait(), second.wait()
+    logger.close()
+
+    assert first_id != second_id
+    data = logger.client.get_run(first_id).data
+    assert data.params == {'model': 'ridge'}
+    assert data.metrics == {'rmse': 4.0}
+    assert [m.value for m in logger.client.get_metric_history(first_id, 'rmse')] \
+        == [4.5, 4.0]
+    assert logger.client.get_run(second_id).data.params == {'model': 'lasso'}
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import SGDRegressor
+
+from taxifare.benchmarks import make_trips
+from taxifare.data import clean_df
+from taxifare.trainer import Trainer
+
+
+def test_run_incremental_skips_empty_chunks():
+    df = clean_df(make_trips(1000))
+    chunks = [df.iloc[:0], df.iloc[:500], df.iloc[:0], df.iloc[500:]]
+    trainer = Trainer(None, None, model=SGDRegressor(random_state=0))
+    trainer.run_incremental(lambda: iter(chunks))
+    assert np.isfinite(trainer.pipeline.predict(df.drop(columns='fare_amount'))).all()
+
+
+def test_run_incremental_without_rows():
+    df = clean_df(make_trips(10))
+    trainer = Trainer(None, None, model=SGDRegressor())
+    with pytest.raises(ValueError, match='no rows'):
+        trainer.run_incremental(lambda: iter([df.iloc[:0]]))
+
+
+def test_evaluate_stream_matches_evaluate(pipeline):
+    df = clean_df(make_trips(1500, seed=1))
+    X, y = df.drop(columns='fare_amount'), df['fare_amount']
+    trainer = Trainer(None, None)
+    trainer.pipeline = pipeline
+    chunks = [df.iloc[:0], df.iloc[:400], df.iloc[:0], df.iloc[400:900], df.iloc[900:]]
+    results = trainer.evaluate_stream(chunks, n_jobs=2)
+    assert results['count'] == len(df)
+    assert results['rmse'] == pytest.approx(trainer.evaluate(X, y))
+    assert results['mae'] == pytest.approx(np.abs(pipeline.predict(X) - y).mean())
+    assert sum(bucket['count'] for bucket in results['by_hour']) == len(df)
+
+
+def test_evaluate_stream_without_rows(pipeline):
+    df = clean_df(make_trips(10))
+    trainer = Trainer(None, None)
+    trainer.pipeline = pipeline
+    with pytest.raises(ValueError, match='no rows'):
+        trainer.evaluate_stream([df.iloc[:0]])
+    with pytest.raises(ValueError, match='no rows'):
+        trainer.evaluate_stream([])
@@ -0,0 +1,35 @@
+import signal
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from uvicorn.config import Config
+
+import app.api
+from app import worker
+from app.registry import LoadedModel
+
+
+@pytest.fixture
+def api(monkeypatch):
+    monkeypatch.setattr(app.api, 'draining', False)
+    monkeypatch.setattr(app.api.registry, 'current',
+                        LoadedModel(None, None, 'v1', 0.0, None))
+    return TestClient(app.api.api)
+
+
+def test_ready_until_draining(api, monkeypatch):
+    assert api.get('/health/ready').json() == {'status': 'ready', 'version': 'v1'}
+    monkeypatch.setattr(app.api, 'draining', True)
+    assert api.get('/health/ready').status_code == 503
+    assert api.get('/health/live').status_code == 200
+
+
+def test_sigterm_drains_before_exiting(api, monkeypatch):
+    monkeypatch.setattr(worker, 'DRAIN_SECONDS', 0.2)
+    server = worker.DrainingServer(Config(app=app.api.api))
+    server.handle_exit(signal.SIGTERM, None)
+    assert app.api.draining and not server.should_exit
+    assert api.get('/health/ready').status_code == 503
+    time.sleep(0.5)
+    assert server.should_exit